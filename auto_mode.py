@@ -0,0 +1,81 @@
+import itertools
+from typing import Optional
+
+import numpy as np
+
+from emulator import REPORT_PERIOD, emulate, image_bits
+
+# Options --auto chooses between; the others (endsave, fix) are kept as the user set them
+AUTO_OPTIONS = ['cautious', 'vertical', 'slowmode', 'optimal', 'invertColormap']
+# Images where more than this fraction of the pixels changes colour along a line are too complex
+# to print without slowmode: too many inking inputs in a row would get dropped
+DEFAULT_MAX_RISK = 0.05
+
+
+def dropped_input_risk(bits: np.ndarray, vertical: bool = False) -> float:
+    """
+    Fraction of the pixels where the colour changes from the previous pixel of the line (or column)
+    """
+    lines = bits.T if vertical else bits
+    return float(np.count_nonzero(np.diff(lines.astype(np.int8), axis=1))) / bits.size
+
+
+def candidate_options(option_list) -> list[dict]:
+    """
+    Every combination of the automatic options, the others being those of option_list
+    """
+    return [dict(option_list, **dict(zip(AUTO_OPTIONS, values)))
+            for values in itertools.product([False, True], repeat=len(AUTO_OPTIONS))]
+
+
+def _score_candidate(item) -> tuple[int, float, bool]:
+    image_data, target, report_period = item
+    result = emulate(image_data, report_period)
+    correct = result.finished and np.array_equal(result.canvas, target)
+    return result.reports, result.seconds, correct
+
+
+def score_print_modes(data: np.ndarray, option_list, encode, max_risk: float = DEFAULT_MAX_RISK,
+                      jobs: Optional[int] = None, report_period: float = REPORT_PERIOD) -> list[dict]:
+    """
+    Emulate every option combination of the image and rank them by print time.
+    encode(data, options) must return the image_data bytes of the image with those options.
+    A combination is valid when it finishes, prints the picture the user asked for, and uses slowmode
+    whenever the dropped input risk of its print direction is over max_risk.
+    """
+    import concurrent.futures
+    candidates = candidate_options(option_list)
+    target = image_bits(encode(data, option_list))
+    items = [(encode(data, options), target, report_period) for options in candidates]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        scores = list(executor.map(_score_candidate, items))
+
+    ranking = []
+    for options, (reports, seconds, correct) in zip(candidates, scores):
+        risk = dropped_input_risk(target, options['vertical'])
+        reliable = options['slowmode'] or risk <= max_risk
+        ranking.append({'options': {option: options[option] for option in AUTO_OPTIONS},
+                        'reports': reports,
+                        'seconds': seconds,
+                        'risk': risk,
+                        'correct': correct,
+                        'valid': correct and reliable})
+    ranking.sort(key=lambda score: (not score['valid'], score['seconds']))
+    return ranking
+
+
+def print_ranking(ranking: list[dict], limit: Optional[int] = None):
+    print(f"{'#':>3} {'cautious':>8} {'vertical':>8} {'slowmode':>8} {'optimal':>7} {'invert':>6}"
+          f" {'reports':>8} {'time':>9} {'risk':>6}  status")
+    for rank, score in enumerate(ranking[:limit], 1):
+        options = score['options']
+        minutes, seconds = divmod(score['seconds'], 60)
+        if score['valid']:
+            status = "ok"
+        elif not score['correct']:
+            status = "wrong picture"
+        else:
+            status = "needs slowmode"
+        print(f"{rank:>3} {options['cautious']!s:>8} {options['vertical']!s:>8} {options['slowmode']!s:>8}"
+              f" {options['optimal']!s:>7} {options['invertColormap']!s:>6} {score['reports']:>8}"
+              f" {int(minutes):>3}m {seconds:4.1f}s {score['risk']:>6.3f}  {status}")
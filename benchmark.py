@@ -0,0 +1,413 @@
+#!/bin/python
+
+import sys, os, getopt
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from generate_route import (get_distance_matrix, find_nearest_reset_positions, get_label, generate_block_visit,
+                            generate_order)
+from route_optimizer import optimize_block_routes
+from partition import DEFAULT_PARTITION, PARTITIONS, divide_ink
+from command_codec import encode_rle, decode_rle, raw_size
+from png2c import load_bilevel, image_to_bits, generate_c_source
+
+# Seconds a stage may get slower than the baseline before it counts as a regression, on top of the ratio
+TIME_NOISE_FLOOR = 0.005
+BENCHMARK_OPTIONS = {'invertColormap': False, 'cautious': False, 'optimal': True, 'slowmode': False,
+                     'endsave': False, 'vertical': False, 'fix': False, 'sparse': False,
+                     'encoding': "auto"}
+# Fixed route optimization budget, so the command counts don't depend on the machine's speed too much
+BENCHMARK_ROUTE_BUDGET = 0.5
+# Packages only the planning modes may import; a plain conversion must get by with Pillow and NumPy
+PLANNING_PACKAGES = ["skimage", "scipy", "tsp_solver", "tqdm"]
+# Milliseconds importing png2c may take in the startup benchmark
+DEFAULT_IMPORT_BUDGET = 250.0
+# Stages counted as planning when comparing the partitions
+PLANNING_STAGES = ["partition", "generate_block_visit", "route_optimizer", "generate_order"]
+
+
+def loop_distance_matrix(entry_exit_point) -> np.ndarray:
+  """
+  The former pairwise distance matrix, kept as the reference for the micro-benchmark
+  """
+  from scipy.spatial.distance import cityblock as manhattan_distance
+  distance_matrix = np.zeros((len(entry_exit_point), len(entry_exit_point)))
+  for i in range(len(entry_exit_point)):
+    for j in range(len(entry_exit_point)):
+      if i == j or j == 0:
+        continue
+      distance_matrix[i][j] = manhattan_distance(entry_exit_point[i][1], entry_exit_point[j][0])
+  return distance_matrix
+
+
+def random_entry_exit_points(n: int, seed: int = 0):
+  rng = np.random.default_rng(seed)
+  points = rng.integers(0, [120, 320], size=(n, 2, 2))
+  return [(point[0], point[1]) for point in points]
+
+
+def best_time(function, repeat: int) -> float:
+  return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def bench_distance_matrix(sizes=(10, 100, 1000), repeat: int = 3):
+  """
+  Compare the pairwise loop with the broadcast distance matrix and the batched nearest reset lookup
+  """
+  print(f"{'n':>6} {'loop (s)':>12} {'broadcast (s)':>14} {'speedup':>9} {'resets (s)':>11}")
+  for n in sizes:
+    entry_exit_point = random_entry_exit_points(n)
+    assert np.array_equal(loop_distance_matrix(entry_exit_point), get_distance_matrix(entry_exit_point))
+    loop_time = best_time(lambda: loop_distance_matrix(entry_exit_point), 1 if n >= 1000 else repeat)
+    broadcast_time = best_time(lambda: get_distance_matrix(entry_exit_point), repeat)
+    exits = np.array([t[1] for t in entry_exit_point])
+    reset_time = best_time(lambda: find_nearest_reset_positions(exits), repeat)
+    print(f"{n:>6} {loop_time:>12.6f} {broadcast_time:>14.6f} {loop_time / broadcast_time:>8.1f}x {reset_time:>11.6f}")
+
+
+def import_times(module: str = "png2c") -> dict[str, int]:
+  """
+  Cumulative import time in microseconds of every module imported by a fresh interpreter importing module,
+  as reported by -X importtime
+  """
+  process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+  times = {}
+  for line in process.stderr.splitlines():
+    fields = line.split("|")
+    if not line.startswith("import time:") or not fields[1].strip().isdigit():
+      continue
+    times[fields[2].strip()] = int(fields[1])
+  return times
+
+
+def bench_startup(repeat: int = 3, budget: float = DEFAULT_IMPORT_BUDGET) -> list[str]:
+  """
+  Time importing png2c, keeping the best of repeat runs, and list what breaks the startup budget:
+  going over budget milliseconds, or importing a package only the planning modes need
+  """
+  runs = [import_times() for _ in range(repeat)]
+  best = min(runs, key=lambda times: times["png2c"])
+  print(f"png2c import time: {best['png2c'] / 1000:.1f}ms (budget: {budget:.0f}ms)")
+  slowest = sorted(((time, name) for name, time in best.items() if "." not in name and name != "png2c"), reverse=True)
+  for time_us, name in slowest[:5]:
+    print(f"  {name}: {time_us / 1000:.1f}ms")
+
+  failures = []
+  if best["png2c"] / 1000 > budget:
+    failures.append(f"importing png2c took {best['png2c'] / 1000:.1f}ms, over the {budget:.0f}ms budget")
+  for package in PLANNING_PACKAGES:
+    if package in best:
+      failures.append(f"{package} is imported at startup")
+  return failures
+
+
+def generate_corpus(seed: int = 0) -> dict[str, Image.Image]:
+  """
+  Synthetic 320x120 images covering the cases the planner sees: empty and full canvases, noise at
+  several densities, gradients dithered by png2c, line art, text and checkerboards
+  """
+  rng = np.random.default_rng(seed)
+  corpus = {}
+
+  def bilevel(black: np.ndarray) -> Image.Image:
+    return Image.fromarray(np.where(black, 0, 255).astype(np.uint8))
+
+  corpus["empty"] = bilevel(np.zeros((120, 320), dtype=bool))
+  corpus["full"] = bilevel(np.ones((120, 320), dtype=bool))
+  for density in (0.05, 0.2, 0.5):
+    corpus[f"noise_{int(density * 100):02d}"] = bilevel(rng.random((120, 320)) < density)
+
+  y, x = np.mgrid[0:120, 0:320]
+  corpus["gradient_linear"] = Image.fromarray((x * 255 / 319).astype(np.uint8))
+  radius = np.hypot(x - 160, y - 60)
+  corpus["gradient_radial"] = Image.fromarray((radius * 255 / radius.max()).astype(np.uint8))
+
+  line_art = Image.new("L", (320, 120), 255)
+  draw = ImageDraw.Draw(line_art)
+  for _ in range(12):
+    draw.line([tuple(rng.integers(0, [320, 120])) for _ in range(4)], fill=0, width=int(rng.integers(1, 4)))
+  draw.ellipse((20, 20, 100, 100), outline=0, width=2)
+  draw.rectangle((200, 30, 300, 90), outline=0)
+  corpus["line_art"] = line_art
+
+  text = Image.new("L", (320, 120), 255)
+  draw = ImageDraw.Draw(text)
+  for row in range(8):
+    draw.text((4, 4 + row * 14), "Splatoon post printer 0123456789 ABC", fill=0)
+  corpus["text"] = text
+
+  corpus["checkerboard_1"] = bilevel((x + y) % 2 == 0)
+  corpus["checkerboard_8"] = bilevel((x // 8 + y // 8) % 2 == 0)
+  return corpus
+
+
+def measure(stage: str, function, results: dict, memory: bool):
+  """
+  Run one stage, recording its wall time, or its peak traced memory when memory is set
+  (tracing slows the stage down, so both are never recorded in the same run)
+  """
+  if not memory:
+    start = time.perf_counter()
+    output = function()
+    results.setdefault(stage, {})['seconds'] = time.perf_counter() - start
+    return output
+  tracemalloc.start()
+  output = function()
+  results.setdefault(stage, {})['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return output
+
+
+def run_pipeline(path: str, stages: dict, memory: bool, partition: str = DEFAULT_PARTITION) -> dict:
+  """
+  Run every stage of the optimal mode pipeline on one image
+  """
+  im = measure("dither", lambda: load_bilevel(path), stages, memory)
+  pixels = np.array(im)
+  ink = pixels if np.sum(pixels) < 38400/2 else 1 - pixels
+  divided_image = measure("partition", lambda: divide_ink(ink.astype(int), partition), stages, memory)
+
+  labels = measure("get_label", lambda: [get_label(item[1]) for item in divided_image], stages, memory)
+  block_routes = measure("generate_block_visit",
+                         lambda: [generate_block_visit(item[1], np.array(item[0])) for item in divided_image],
+                         stages, memory)
+  plan = measure("route_optimizer", lambda: optimize_block_routes(block_routes, BENCHMARK_ROUTE_BUDGET), stages, memory)
+  bin_command_list = measure("generate_order", lambda: generate_order(plan.get_visit_list()), stages, memory)
+  measure("encode", lambda: generate_c_source(image_to_bits(im), BENCHMARK_OPTIONS, [], bin_command_list),
+          stages, memory)
+  stream = measure("encode_rle", lambda: encode_rle(bin_command_list), stages, memory)
+  measure("decode_rle", lambda: decode_rle(stream), stages, memory)
+  return {'stages': stages,
+          'components': int(sum(label_count for _, label_count in labels)),
+          'commands': int(len(bin_command_list)),
+          'baseline_commands': int(plan.baseline_cost),
+          'raw_bytes': raw_size(bin_command_list),
+          'rle_bytes': int(len(stream))}
+
+
+def bench_image(path: str, memory: bool = True, partition: str = DEFAULT_PARTITION) -> dict:
+  """
+  Time every stage on one image, then trace their peak memory in a second run
+  """
+  result = run_pipeline(path, {}, False, partition)
+  if memory:
+    run_pipeline(path, result['stages'], True, partition)
+  return result
+
+
+def run_suite(memory: bool = True, corpus_dir: str = None, partition: str = DEFAULT_PARTITION) -> dict:
+  corpus = generate_corpus()
+  get_label(np.eye(4, dtype=int))  # Warm up the lazily loaded libraries before timing anything
+  results = {'meta': {'python': platform.python_version(),
+                      'numpy': np.__version__,
+                      'machine': platform.machine(),
+                      'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      'partition': partition},
+             'images': {}}
+  with tempfile.TemporaryDirectory() as temporary_dir:
+    directory = corpus_dir or temporary_dir
+    os.makedirs(directory, exist_ok=True)
+    for name, image in corpus.items():
+      path = os.path.join(directory, f"{name}.png")
+      image.save(path)
+      results['images'][name] = bench_image(path, memory, partition)
+      print_image_result(name, results['images'][name])
+  return results
+
+
+def print_image_result(name: str, result: dict):
+  stages = ", ".join(f"{stage} {values['seconds'] * 1000:.1f}ms" for stage, values in result['stages'].items())
+  print(f"{name:>16}: {result['components']:>6} components, {result['commands']:>6} commands | {stages}")
+
+
+def compare_partitions(corpus_dir: str = None) -> dict:
+  """
+  Plan the corpus on the fixed 40x40 grid and on the adaptive quadtree, and print the planning time
+  and command count of both
+  """
+  results = {}
+  for partition in PARTITIONS:
+    print(f"\n-= {partition} =-")
+    results[partition] = run_suite(False, corpus_dir, partition)
+
+  print(f"\n{'':>16} {'planning time':>19} {'commands':>19}")
+  print(f"{'image':>16} {'grid':>9} {'adaptive':>9} {'grid':>9} {'adaptive':>9}")
+  totals = {partition: [0.0, 0] for partition in PARTITIONS}
+  for name in results['grid']['images']:
+    seconds, commands = {}, {}
+    for partition in PARTITIONS:
+      result = results[partition]['images'][name]
+      seconds[partition] = sum(result['stages'][stage]['seconds'] for stage in PLANNING_STAGES)
+      commands[partition] = result['commands']
+      totals[partition][0] += seconds[partition]
+      totals[partition][1] += commands[partition]
+    print(f"{name:>16} {seconds['grid']:>8.2f}s {seconds['adaptive']:>8.2f}s"
+          f" {commands['grid']:>9} {commands['adaptive']:>9}")
+  print(f"{'total':>16} {totals['grid'][0]:>8.2f}s {totals['adaptive'][0]:>8.2f}s"
+        f" {totals['grid'][1]:>9} {totals['adaptive'][1]:>9}")
+  return results
+
+
+def compare_encodings(corpus_dir: str = None) -> dict:
+  """
+  Plan the corpus and print the size of every route packed raw and run-length encoded,
+  with the time taken to encode and decode it
+  """
+  results = run_suite(False, corpus_dir)
+  print(f"\n{'image':>16} {'commands':>9} {'raw':>7} {'rle':>7} {'saved':>6} {'encode':>9} {'decode':>9}")
+  totals = [0, 0, 0]
+  for name, result in results['images'].items():
+    raw, rle = result['raw_bytes'], result['rle_bytes']
+    saved = 1 - rle / raw if raw > 0 else 0.0
+    totals = [totals[0] + result['commands'], totals[1] + raw, totals[2] + rle]
+    print(f"{name:>16} {result['commands']:>9} {raw:>7} {rle:>7} {saved:>6.1%}"
+          f" {result['stages']['encode_rle']['seconds'] * 1000:>7.1f}ms"
+          f" {result['stages']['decode_rle']['seconds'] * 1000:>7.1f}ms")
+  print(f"{'total':>16} {totals[0]:>9} {totals[1]:>7} {totals[2]:>7} {1 - totals[2] / max(totals[1], 1):>6.1%}")
+  return results
+
+
+def compare_results(baseline: dict, current: dict, time_ratio: float = 1.5, memory_ratio: float = 1.5,
+                    command_ratio: float = 1.0) -> list[str]:
+  """
+  List the regressions of current against baseline: stages slower or using more memory than the ratios allow,
+  and routes with more commands
+  """
+  regressions = []
+  for name, result in current['images'].items():
+    if name not in baseline['images']:
+      continue
+    base = baseline['images'][name]
+    for stage, values in result['stages'].items():
+      base_values = base['stages'].get(stage)
+      if base_values is None:
+        continue
+      if values['seconds'] > base_values['seconds'] * time_ratio + TIME_NOISE_FLOOR:
+        regressions.append(f"{name}/{stage}: {base_values['seconds']:.4f}s -> {values['seconds']:.4f}s")
+      if ('peak_bytes' in values and 'peak_bytes' in base_values
+          and values['peak_bytes'] > base_values['peak_bytes'] * memory_ratio):
+        regressions.append(f"{name}/{stage}: {base_values['peak_bytes']} -> {values['peak_bytes']} bytes peak")
+    if result['commands'] > base['commands'] * command_ratio:
+      regressions.append(f"{name}: {base['commands']} -> {result['commands']} commands")
+  return regressions
+
+
+def main(argv):
+  opts, args = getopt.getopt(argv, "hr:o:c:",
+                             ["help", "repeat=", "output=", "compare=", "micro", "nomemory", "corpus=",
+                              "timeratio=", "memoryratio=", "startup", "importbudget=", "partition=", "partitions",
+                              "encodings"])
+  repeat = 3
+  output_file = None
+  baseline_file = None
+  micro = False
+  startup = False
+  import_budget = DEFAULT_IMPORT_BUDGET
+  memory = True
+  corpus_dir = None
+  time_ratio = 1.5
+  memory_ratio = 1.5
+  partition = DEFAULT_PARTITION
+  partitions = False
+  encodings = False
+  for opt, arg in opts:
+    if opt in ['-h', '--help']:
+      usage()
+      sys.exit()
+    elif opt in ['-r', '--repeat']:
+      repeat = int(arg)
+    elif opt in ['-o', '--output']:
+      output_file = arg
+    elif opt in ['-c', '--compare']:
+      baseline_file = arg
+    elif opt == '--micro':
+      micro = True
+    elif opt == '--startup':
+      startup = True
+    elif opt == '--importbudget':
+      import_budget = float(arg)
+    elif opt == '--nomemory':
+      memory = False
+    elif opt == '--corpus':
+      corpus_dir = arg
+    elif opt == '--timeratio':
+      time_ratio = float(arg)
+    elif opt == '--memoryratio':
+      memory_ratio = float(arg)
+    elif opt == '--partition':
+      partition = arg
+    elif opt == '--partitions':
+      partitions = True
+    elif opt == '--encodings':
+      encodings = True
+
+  if micro:
+    bench_distance_matrix(repeat=repeat)
+    return
+
+  if startup:
+    failures = bench_startup(repeat, import_budget)
+    if len(failures) > 0:
+      print(f"\nStartup budget broken:")
+      for failure in failures:
+        print(f"  {failure}")
+      sys.exit(1)
+    print("\nStartup within budget!")
+    return
+
+  if partitions or encodings:
+    results = compare_partitions(corpus_dir) if partitions else compare_encodings(corpus_dir)
+    if output_file is not None:
+      with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+      print(f"\nResults saved to {output_file}!")
+    return
+
+  results = run_suite(memory, corpus_dir, partition)
+  if output_file is not None:
+    with open(output_file, 'w') as f:
+      json.dump(results, f, indent=2)
+    print(f"\nResults saved to {output_file}!")
+
+  if baseline_file is not None:
+    with open(baseline_file) as f:
+      baseline = json.load(f)
+    regressions = compare_results(baseline, results, time_ratio, memory_ratio)
+    if len(regressions) > 0:
+      print(f"\n{len(regressions)} regressions against {baseline_file}:")
+      for regression in regressions:
+        print(f"  {regression}")
+      sys.exit(1)
+    print(f"\nNo regressions against {baseline_file}!")
+
+
+def usage():
+  print("To run the benchmarks: benchmark.py [-options]")
+  print("\n--help [-h]: Show this help list")
+  print("--output [-o] <results.json>: Save the results as JSON")
+  print("--compare [-c] <baseline.json>: Compare against saved results, exiting with 1 on regressions")
+  print("--timeratio <R>: How many times slower a stage may get before it's a regression (default: 1.5)")
+  print("--memoryratio <R>: How many times more memory a stage may use before it's a regression (default: 1.5)")
+  print("--nomemory: Skip the second run tracing the peak memory of every stage")
+  print("--corpus <directory>: Keep the generated images in this directory")
+  print("--partition <adaptive|grid>: How the images are divided into blocks (default: grid)")
+  print("--partitions: Plan the corpus with both partitions instead, comparing their planning time and commands")
+  print("--encodings: Compare the size of the routes packed raw and run-length encoded, and their encoding time")
+  print("--micro: Run the distance matrix micro-benchmark instead")
+  print("--startup: Time importing png2c with -X importtime instead, exiting with 1 over budget")
+  print("  * Importing any of the planning packages (scikit-image, SciPy, tsp_solver, tqdm) also breaks the budget.")
+  print("--importbudget <ms>: Milliseconds importing png2c may take (default: 250)")
+  print("--repeat [-r] N: Keep the best time of N runs in the micro-benchmark and the startup benchmark (default: 3)")
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
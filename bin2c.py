@@ -1,47 +1,180 @@
 #!/bin/python
 
-import sys, getopt
+import sys, os, getopt
+
+import numpy as np
+
+# A raw frame holds one byte per pixel, 0 or 1
+FRAME_PIXELS = 320 * 120
+# Frames packed at once, so that large dumps are read in chunks rather than all at once
+CHUNK_FRAMES = 64
+FORMATS = {"c": ".c", "bin": ".bin", "hex": ".hex"}
+HEX_TABLE = [hex(i) for i in range(256)]
+C_HEADER = "#include <stdint.h>\n#include <avr/pgmspace.h>\n\n"
+# Data bytes per Intel HEX record
+HEX_RECORD_BYTES = 16
+
+
+def open_frames(filename: str) -> np.ndarray:
+  """
+  Memory-map a raw dump as a (frames, 38400) array, without reading it
+  """
+  size = os.path.getsize(filename)
+  if size == 0 or size % FRAME_PIXELS != 0:
+    raise ValueError(f"{filename} holds {size} bytes, which isn't a whole number of {FRAME_PIXELS} byte frames!")
+  return np.memmap(filename, dtype=np.uint8, mode='r', shape=(size // FRAME_PIXELS, FRAME_PIXELS))
+
+
+def pack_frames(frames: np.ndarray, invert: bool = False) -> np.ndarray:
+  """
+  Pack every frame into 4800 bytes, 8 pixels per byte with the first one in the lowest bit,
+  and append the end byte (always 0x0). Returns a (frames, 4801) array.
+  """
+  packed = np.packbits(np.asarray(frames) != 0, axis=1, bitorder="little")
+  if invert:
+    packed = np.invert(packed)
+  return np.pad(packed, ((0, 0), (0, 1)))
+
+
+def format_c_array(image_data: np.ndarray) -> str:
+  return (C_HEADER
+          + "const uint8_t image_data[" + hex(len(image_data)) + "] PROGMEM = {"
+          + ", ".join([HEX_TABLE[value] for value in image_data.tolist()])
+          + "};\n")
+
+
+def format_intel_hex(image_data: np.ndarray) -> str:
+  """
+  Intel HEX records of 16 data bytes from address 0, with extended linear address records past 64KiB
+  """
+  lines = []
+  for segment_start in range(0, len(image_data), 0x10000):
+    segment = image_data[segment_start:segment_start + 0x10000]
+    if segment_start > 0:
+      upper = [0x02, 0x00, 0x00, 0x04, segment_start >> 24 & 0xFF, segment_start >> 16 & 0xFF]
+      lines.append(":" + bytes(upper + [-sum(upper) & 0xFF]).hex().upper())
+    record_count = (len(segment) + HEX_RECORD_BYTES - 1) // HEX_RECORD_BYTES
+    data = np.pad(segment, (0, record_count * HEX_RECORD_BYTES - len(segment))).reshape(record_count, -1)
+    lengths = np.full(record_count, HEX_RECORD_BYTES)
+    lengths[-1] = len(segment) - (record_count - 1) * HEX_RECORD_BYTES
+    addresses = np.arange(record_count) * HEX_RECORD_BYTES
+    # The checksum covers the record length, the address, the record type (0) and the data
+    sums = lengths + (addresses >> 8) + (addresses & 0xFF) + data.sum(axis=1, dtype=np.int64)
+    checksums = -sums & 0xFF
+    for length, address, row, checksum in zip(lengths.tolist(), addresses.tolist(), data, checksums.tolist()):
+      lines.append(f":{length:02X}{address:04X}00{row[:length].tobytes().hex().upper()}{checksum:02X}")
+  lines.append(":00000001FF")
+  return "\n".join(lines) + "\n"
+
+
+def write_image_data(image_data: np.ndarray, filename: str, output_format: str = "c"):
+  if output_format == "bin":
+    with open(filename, 'wb') as f:
+      f.write(image_data.tobytes())
+    return
+  text = format_c_array(image_data) if output_format == "c" else format_intel_hex(image_data)
+  with open(filename, 'w') as f:
+    f.write(text)
+
+
+def output_names(filename: str, frame_count: int, output_dir: str, output_format: str) -> list[str]:
+  """
+  <output_dir>/<dump name>.<ext>, numbered <dump name>_<frame>.<ext> when the dump holds many frames
+  """
+  stem = os.path.join(output_dir, os.path.splitext(os.path.basename(filename))[0])
+  if frame_count == 1:
+    return [stem + FORMATS[output_format]]
+  return [f"{stem}_{frame:03d}{FORMATS[output_format]}" for frame in range(frame_count)]
+
+
+def convert_dump(filename: str, output_paths: list[str], output_format: str = "c", invert: bool = False):
+  """
+  Convert every frame of a raw dump into its own output file, CHUNK_FRAMES frames at a time
+  """
+  frames = open_frames(filename)
+  for start in range(0, len(frames), CHUNK_FRAMES):
+    for image_data, output_path in zip(pack_frames(frames[start:start + CHUNK_FRAMES], invert),
+                                       output_paths[start:start + CHUNK_FRAMES]):
+      write_image_data(image_data, output_path, output_format)
+
 
 def main(argv):
-  opts, args = getopt.getopt(argv, "hi")
+  opts, args = getopt.getopt(argv, "hif:o:d:", ["help", "invertcmap", "format=", "output=", "outdir="])
 
   invertColormap = False
+  output_format = "c"
+  output_file = None
+  output_dir = None
   for opt, arg in opts:
-    if opt == '-h':
+    if opt in ['-h', '--help']:
       usage()
       sys.exit()
-    elif opt == '-i':
+    elif opt in ['-i', '--invertcmap']:
       invertColormap = True
+    elif opt in ['-f', '--format']:
+      if arg not in FORMATS:
+        print("The format must be c, bin or hex! Using c!")
+        arg = "c"
+      output_format = arg
+    elif opt in ['-o', '--output']:
+      output_file = arg
+    elif opt in ['-d', '--outdir']:
+      output_dir = arg
 
-  data = open(args[0], 'rb').read()
-
-  str_out = "#include <stdint.h>\n#include <avr/pgmspace.h>\n\nconst uint8_t image_data[0x12c1] PROGMEM = {"
-  for i in range(0, 4800):          # (320*120)/8
-    val = 0;
+  try:
+    frame_counts = [len(open_frames(filename)) for filename in args]
+  except (OSError, ValueError) as e:
+    print(f"ERROR: {e}")
+    sys.exit(1)
 
-    for j in range(0, 8):
-        val |= ord(data[(i * 8) + j]) << j
+  if output_dir is None and output_file is None and len(args) == 1 and frame_counts[0] == 1:
+    output_file = "image" + FORMATS[output_format]
+  if output_file is not None and (len(args) > 1 or frame_counts[0] > 1):
+    print("--output only names a single frame! Use --outdir for many.")
+    sys.exit(1)
+  if output_file is not None:
+    all_output_paths = [[output_file]]
+  else:
+    all_output_paths = [output_names(filename, frame_count, output_dir or ".", output_format)
+                        for filename, frame_count in zip(args, frame_counts)]
+  # Dumps of different directories sharing a name would overwrite each other, so nothing is written then
+  writers = {}
+  for filename, output_paths in zip(args, all_output_paths):
+    for output_path in output_paths:
+      writers.setdefault(os.path.normcase(os.path.abspath(output_path)), []).append((filename, output_path))
+  clashes = {}
+  for writer in writers.values():
+    if len(writer) > 1:
+      clashes.setdefault(tuple(filename for filename, _ in writer), writer[0][1])
+  if clashes:
+    for filenames, output_path in clashes.items():
+      print(f"ERROR: {', '.join(filenames)} would be saved to the same file ({output_path})!")
+    print("Rename them or convert them into different --outdir directories.")
+    sys.exit(1)
+  if output_dir is not None and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
 
-    if (invertColormap):
-      val = ~val & 0xFF;
+  colormap = "inverted" if invertColormap else "original"
+  for filename, frame_count, output_paths in zip(args, frame_counts, all_output_paths):
+    convert_dump(filename, output_paths, output_format, invertColormap)
+    if frame_count == 1:
+      print(f"{filename} converted with {colormap} colormap and saved to {output_paths[0]}")
     else:
-      val = val & 0xFF;
-
-    str_out += hex(val) + ", "
-
-  str_out += "0x0};\n"
+      print(f"{filename}: {frame_count} frames converted with {colormap} colormap and saved to "
+            f"{output_paths[0]} ... {output_paths[-1]}")
 
-  with open('image.c', 'w') as f:
-    f.write(str_out)
-
-  if (invertColormap):
-      print("{} converted with inverted colormap and saved to image.c".format(args[0]))
-  else:
-      print("{} converted with original colormap and saved to image.c".format(args[0]))
 
 def usage():
   print("To convert to image.c: bin2c.py yourImage.data")
   print("To convert to an inverted image.c: bin2c.py -i yourImage.data")
+  print("\n--help [-h]: Show this help list")
+  print("--invertcmap [-i]: Invert the colormap")
+  print("--format [-f] <c|bin|hex>: Save a .c source, the raw image_data bytes or Intel HEX (default: c)")
+  print("--output [-o] <file>: Where to save a single frame (default: image.c, image.bin or image.hex)")
+  print("--outdir [-d] <directory>: Save every frame as <directory>/<dump name>.<ext> instead")
+  print("  * Dumps can hold many 38400 byte frames, which are numbered <dump name>_000.<ext>, <dump name>_001.<ext>...")
+  print("    Many dumps and dumps of many frames are saved to the current directory unless --outdir is given.")
+  print("    Dumps that would be saved to the same file (e.g. a/x.data and b/x.data) are refused.")
 
 if __name__ == "__main__":
   if len(sys.argv[1:]) == 0:
@@ -0,0 +1,103 @@
+import numpy as np
+
+ENCODINGS = ["auto", "raw", "rle"]
+# Shortest run of one command stored as a run token; shorter runs cost less left in a literal token
+MIN_RUN = 10
+# Most commands a literal token holds
+MAX_LITERAL = 128
+# Run lengths above MIN_RUN held by the first byte of a run token; longer ones continue in 7-bit bytes
+RUN_FIRST_BITS = 4
+
+
+def command_runs(commands: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Start and length of every run of equal commands
+    """
+    commands = np.asarray(commands, dtype=np.uint8)
+    if len(commands) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    starts = np.flatnonzero(np.diff(commands, prepend=commands[0] ^ 1))
+    return starts, np.diff(starts, append=len(commands))
+
+
+def pack_literal(commands: np.ndarray) -> np.ndarray:
+    """
+    4 two-bit commands per byte, the first command in the lowest bits, like the raw stream
+    """
+    commands = np.pad(np.asarray(commands, dtype=np.uint8) & 0x3, (0, -len(commands) % 4)).reshape(-1, 4)
+    return commands[:, 0] | commands[:, 1] << 2 | commands[:, 2] << 4 | commands[:, 3] << 6
+
+
+def run_token(command: int, length: int) -> list[int]:
+    extra = length - MIN_RUN
+    first = 1 | command << 1 | (extra & (1 << RUN_FIRST_BITS) - 1) << 3
+    extra >>= RUN_FIRST_BITS
+    token = [first | (0x80 if extra else 0)]
+    while extra:
+        token.append(extra & 0x7F | (0x80 if extra >> 7 else 0))
+        extra >>= 7
+    return token
+
+
+def encode_rle(commands: np.ndarray) -> np.ndarray:
+    """
+    Run-length encode a 2-bit command list into a stream of tokens:
+      * literal: bit 0 clear, bits 1-7 the command count - 1, then the commands packed 4 per byte
+      * run: bit 0 set, bits 1-2 the command, bits 3-6 the low bits of the length - MIN_RUN,
+        bit 7 set when the rest of the length follows in 7-bit bytes, low bits first
+    Corner resets and long straight moves shrink to a few bytes, while short turns cost as much as raw.
+    """
+    commands = np.asarray(commands, dtype=np.uint8) & 0x3
+    starts, lengths = command_runs(commands)
+    long_runs = np.flatnonzero(lengths >= MIN_RUN)
+    tokens = []
+    position = 0
+    for run in np.append(long_runs, len(starts)).tolist():
+        end = int(starts[run]) if run < len(starts) else len(commands)
+        for literal_start in range(position, end, MAX_LITERAL):
+            literal = commands[literal_start:min(literal_start + MAX_LITERAL, end)]
+            tokens.append(np.array([len(literal) - 1 << 1], dtype=np.uint8))
+            tokens.append(pack_literal(literal))
+        if run < len(starts):
+            tokens.append(np.array(run_token(int(commands[end]), int(lengths[run])), dtype=np.uint8))
+            position = end + int(lengths[run])
+    return np.concatenate(tokens) if tokens else np.empty(0, dtype=np.uint8)
+
+
+def decode_rle(stream: np.ndarray) -> np.ndarray:
+    """
+    Reference decoder of encode_rle, reading the tokens one by one the way the firmware would
+    """
+    stream = np.asarray(stream, dtype=np.uint8)
+    data = stream.tolist()
+    pieces = []
+    i = 0
+    while i < len(data):
+        first = data[i]
+        if first & 1 == 0:
+            count = (first >> 1) + 1
+            packed = stream[i + 1:i + 1 + (count + 3) // 4]
+            if len(packed) * 4 < count:
+                raise ValueError(f"A literal of {count} commands is cut short by the end of the stream!")
+            pieces.append((packed[:, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8) & 0x3).reshape(-1)[:count])
+            i += 1 + len(packed)
+            continue
+        extra, shift, byte = first >> 3 & (1 << RUN_FIRST_BITS) - 1, RUN_FIRST_BITS, first
+        i += 1
+        while byte & 0x80:
+            if i >= len(data):
+                raise ValueError("A run length is cut short by the end of the stream!")
+            byte = data[i]
+            extra |= (byte & 0x7F) << shift
+            shift += 7
+            i += 1
+        pieces.append(np.full(MIN_RUN + extra, first >> 1 & 0x3, dtype=np.uint8))
+    return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.uint8)
+
+
+def rle_size(commands: np.ndarray) -> int:
+    return len(encode_rle(commands))
+
+
+def raw_size(commands: np.ndarray) -> int:
+    return (len(commands) + 3) // 4
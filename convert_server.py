@@ -0,0 +1,280 @@
+#!/bin/python
+
+import sys, os, getopt
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import shlex
+import time
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 16
+# Seconds a job may run before its worker is killed, e.g. on a runaway TSP
+DEFAULT_JOB_TIMEOUT = 120.0
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# Options that only make sense for the command line, not for a single job sent to the server
+REJECTED_OPTIONS = {"-h", "--help", "-p", "--preview", "-b", "--savebilevel", "--batch", "--repair", "--auto"}
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+               504: "Gateway Timeout"}
+
+
+class JobError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def warm_up():
+    """
+    Import the whole planning stack and run it once, so the first job doesn't pay for it
+    """
+    import numpy as np
+    from generate_route import generate_block_visit
+    generate_block_visit(np.eye(3, dtype=int), np.zeros(2, dtype=int))
+
+
+def convert_job(image_bytes: bytes, arguments: list[str], output_format: str) -> dict:
+    """
+    Convert one image with png2c options, returning its C source (or its image_data bytes in base64) and stats
+    """
+    import png2c
+    rejected = [argument for argument in arguments if argument.split("=")[0] in REJECTED_OPTIONS]
+    if rejected:
+        raise ValueError(f"Options not available on the server: {', '.join(rejected)}")
+    option_list, all_to_fix, _, _, _ = png2c.parse_arguments(arguments)
+    # The workers already are the parallelism, so each job plans its blocks serially
+    option_list['plan_jobs'] = 1
+    if option_list['plan_deadline'] is None:
+        option_list['plan_deadline'] = png2c.BATCH_PLAN_DEADLINE
+
+    start = time.perf_counter()
+    im = png2c.open_bilevel(io.BytesIO(image_bytes), option_list, False)
+    image_data, stats = png2c.convert_image(im, option_list, all_to_fix)
+    stats['seconds'] = time.perf_counter() - start
+    if output_format == "bin":
+        return {'data': base64.b64encode(image_data.tobytes()).decode("ascii"), 'stats': stats}
+    return {'source': png2c.format_c_array(png2c.hex_tokens(image_data)), 'stats': stats}
+
+
+def worker_main(connection):
+    # Printing from a worker would only garble the server's output
+    sys.stdout = open(os.devnull, 'w')
+    warm_up()
+    connection.send("ready")
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        try:
+            connection.send((200, convert_job(*job)))
+        except (ValueError, OSError, getopt.GetoptError) as e:
+            connection.send((400, {'error': str(e)}))
+        except Exception as e:
+            connection.send((500, {'error': f"{type(e).__name__}: {e}"}))
+
+
+class Worker:
+    """
+    A warm process converting one job at a time, replaced by a fresh one when a job runs out of time
+    """
+    def __init__(self):
+        self.process = None
+        self.connection = None
+
+    async def start(self):
+        # Spawned rather than forked, so the workers don't inherit the event loop
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        await asyncio.to_thread(self.connection.recv)
+
+    async def run(self, job, timeout: Optional[float]) -> tuple[int, dict]:
+        self.connection.send(job)
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self.connection.recv), timeout)
+        except (asyncio.TimeoutError, EOFError) as e:
+            self.process.kill()
+            self.process.join()
+            self.connection.close()
+            await self.start()
+            if isinstance(e, EOFError):
+                raise JobError(500, "The worker died while converting the image")
+            raise JobError(504, f"The conversion took more than {timeout} seconds")
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class ConversionServer:
+    """
+    Serve png2c conversions over HTTP, on localhost or a Unix socket.
+    Jobs wait in a bounded queue, and as many of them as there are warm workers run at the same time.
+    """
+    def __init__(self, workers: int, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 job_timeout: Optional[float] = DEFAULT_JOB_TIMEOUT):
+        self.workers = [Worker() for _ in range(workers)]
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.job_timeout = job_timeout
+        self.stats = {'done': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0}
+
+    async def start_workers(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        for worker in self.workers:
+            asyncio.create_task(self.serve_jobs(worker))
+
+    async def serve_jobs(self, worker: Worker):
+        while True:
+            job, future = await self.queue.get()
+            try:
+                future.set_result(await worker.run(job, self.job_timeout))
+            except JobError as e:
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def submit(self, job) -> tuple[int, dict]:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise JobError(503, "Too many jobs waiting, try again later")
+        try:
+            status, result = await future
+        except JobError as e:
+            self.stats['timeouts' if e.status == 504 else 'failed'] += 1
+            raise
+        self.stats['done' if status == 200 else 'failed'] += 1
+        return status, result
+
+    async def handle_request(self, method: str, target: str, body: bytes) -> tuple[int, dict]:
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path == "/status":
+            return 200, dict(self.stats, queued=self.queue.qsize(), workers=len(self.workers))
+        if url.path != "/convert":
+            raise JobError(404, f"No such endpoint: {url.path}")
+        if method != "POST":
+            raise JobError(405, "Send the image with POST")
+        output_format = query.get("format", ["c"])[0]
+        if output_format not in ("c", "bin"):
+            raise JobError(400, "The format must be c or bin")
+        if len(body) == 0:
+            raise JobError(400, "The request holds no image")
+        arguments = shlex.split(query.get("options", [""])[0])
+        return await self.submit((body, arguments, output_format))
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request_line = (await reader.readline()).decode("latin-1").split()
+                if len(request_line) != 3:
+                    raise JobError(400, "Malformed request line")
+                method, target, _ = request_line
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_REQUEST_SIZE:
+                    raise JobError(413, f"Images are limited to {MAX_REQUEST_SIZE} bytes")
+                body = await reader.readexactly(length)
+                status, result = await self.handle_request(method, target, body)
+            except JobError as e:
+                status, result = e.status, {'error': str(e)}
+            except (ValueError, asyncio.IncompleteReadError):
+                status, result = 400, {'error': "Malformed request"}
+            payload = json.dumps(result).encode()
+            writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(payload)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int, socket_path: Optional[str], workers: int, queue_size: int,
+                job_timeout: Optional[float]):
+    server = ConversionServer(workers, queue_size, job_timeout)
+    await server.start_workers()
+    if socket_path is not None:
+        listener = await asyncio.start_unix_server(server.handle_connection, path=socket_path)
+        print(f"Serving conversions on {socket_path} with {workers} workers!")
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host, port)
+        print(f"Serving conversions on http://{host}:{port} with {workers} workers!")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        for worker in server.workers:
+            worker.stop()
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hw:q:t:", ["help", "host=", "port=", "socket=", "workers=", "queue=",
+                                                  "timeout="])
+    host, port, socket_path = DEFAULT_HOST, DEFAULT_PORT, None
+    workers = os.cpu_count() or 1
+    queue_size = DEFAULT_QUEUE_SIZE
+    job_timeout = DEFAULT_JOB_TIMEOUT
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage()
+            sys.exit()
+        elif opt == '--host':
+            host = arg
+        elif opt == '--port':
+            port = int(arg)
+        elif opt == '--socket':
+            socket_path = arg
+        elif opt in ['-w', '--workers']:
+            workers = int(arg)
+        elif opt in ['-q', '--queue']:
+            queue_size = int(arg)
+        elif opt in ['-t', '--timeout']:
+            job_timeout = float(arg) if float(arg) > 0 else None
+
+    try:
+        asyncio.run(serve(host, port, socket_path, workers, queue_size, job_timeout))
+    except KeyboardInterrupt:
+        print("\nServer stopped!")
+
+
+def usage():
+    print("To serve conversions: convert_server.py [-options]")
+    print("\n--help [-h]: Show this help list")
+    print("--host <address>: Address to listen on (default: 127.0.0.1)")
+    print("--port <N>: Port to listen on (default: 8765)")
+    print("--socket <path>: Listen on a Unix socket instead")
+    print("--workers [-w] <N>: How many images to convert at the same time (default: number of CPU cores)")
+    print("--queue [-q] <N>: How many jobs may wait for a worker before new ones are turned away (default: 16)")
+    print("--timeout [-t] <seconds>: Time a job may take before its worker is restarted, 0 for none (default: 120)")
+    print("\nPOST the image to /convert?options=<png2c options>&format=<c|bin>, e.g.:")
+    print("  curl --data-binary @image.png 'http://127.0.0.1:8765/convert?options=-o%20-e'")
+    print("The answer is JSON holding the C source (or the image_data bytes in base64) and the image stats.")
+    print("GET /status shows the jobs done and waiting.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+import functools
+import time
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+DITHER_METHODS = ["floyd", "none", "bayer", "atkinson", "bluenoise", "clustered"]
+# Tried first by --dither=auto: the ordered dithers are the cheapest to plan, error diffusion the most expensive
+AUTO_DITHER_ORDER = ["clustered", "bayer", "bluenoise", "atkinson", "floyd", "none"]
+# Seconds --dither=auto may spend planning candidates; the first candidate is always planned
+DEFAULT_DITHER_BUDGET = 20.0
+# How much the visual error weighs against the input count when --dither=auto ranks the candidates
+DITHER_ERROR_WEIGHT = 1.0
+BINOMIAL_KERNEL = np.array([1, 4, 6, 4, 1]) / 16
+
+
+def bayer_matrix(size: int = 8) -> np.ndarray:
+    """
+    Bayer index matrix of size x size (a power of 2), holding every value from 0 to size^2 - 1
+    """
+    matrix = np.zeros((1, 1), dtype=int)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def clustered_dot_matrix(size: int = 8) -> np.ndarray:
+    """
+    Index matrix growing one dot from the centre of each size x size cell, so that dark areas print as solid blobs
+    """
+    y, x = np.mgrid[0:size, 0:size] + 0.5 - size / 2
+    # Ties are broken by angle, so the dot grows round rather than in rings of equal indices
+    order = np.lexsort((np.arctan2(y, x).reshape(-1), np.hypot(x, y).reshape(-1)))
+    matrix = np.empty(size * size, dtype=int)
+    matrix[order] = np.arange(size * size)
+    return matrix.reshape(size, size)
+
+
+@functools.lru_cache(maxsize=None)
+def blue_noise_matrix(size: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    Index matrix of size x size blue noise, approximated by high-pass filtering white noise a few times
+    and ranking the result, so that neighbouring thresholds are as different as possible
+    """
+    noise = np.random.default_rng(seed).random((size, size))
+    for _ in range(4):
+        noise = noise - blur(noise, wrap=True)
+        noise = np.argsort(np.argsort(noise.reshape(-1))).reshape(size, size) / (size * size)
+    return np.argsort(np.argsort(noise.reshape(-1))).reshape(size, size)
+
+
+def blur(image: np.ndarray, wrap: bool = False) -> np.ndarray:
+    """
+    Separable binomial blur, roughly how the eye averages neighbouring pixels
+    """
+    mode = "wrap" if wrap else "edge"
+    radius = len(BINOMIAL_KERNEL) // 2
+    for axis in (0, 1):
+        padded = np.pad(image, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)], mode=mode)
+        length = image.shape[axis]
+        image = sum(weight * np.take(padded, np.arange(i, i + length), axis=axis)
+                    for i, weight in enumerate(BINOMIAL_KERNEL))
+    return image
+
+
+def ordered_dither(gray: np.ndarray, index_matrix: np.ndarray) -> np.ndarray:
+    """
+    Black wherever the gray level is under the tiled threshold
+    """
+    levels = index_matrix.size
+    thresholds = (index_matrix + 0.5) / levels
+    reps = (-(-gray.shape[0] // thresholds.shape[0]), -(-gray.shape[1] // thresholds.shape[1]))
+    return gray < np.tile(thresholds, reps)[:gray.shape[0], :gray.shape[1]]
+
+
+def atkinson_dither(gray: np.ndarray) -> np.ndarray:
+    """
+    Atkinson error diffusion, spreading 6/8 of the error of each pixel to its 6 next neighbours.
+    Pixel (y, x) only depends on pixels of smaller x + 2y, so every such anti-diagonal is processed at once.
+    """
+    height, width = gray.shape
+    values = np.zeros((height + 2, width + 4))  # Room for the error spilled past the edges
+    values[:height, 2:width + 2] = gray
+    black = np.zeros((height, width), dtype=bool)
+    y, x = np.mgrid[0:height, 0:width]
+    wave = (x + 2 * y).reshape(-1)
+    order = np.argsort(wave, kind="stable")
+    bounds = np.searchsorted(wave[order], np.arange(wave.max() + 2))
+    ys, xs = y.reshape(-1)[order], x.reshape(-1)[order] + 2
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        wy, wx = ys[start:stop], xs[start:stop]
+        old = values[wy, wx]
+        is_black = old < 0.5
+        black[wy, wx - 2] = is_black
+        error = (old - np.where(is_black, 0.0, 1.0)) / 8
+        for dy, dx in ((0, 1), (0, 2), (1, -1), (1, 0), (1, 1), (2, 0)):
+            values[wy + dy, wx + dx] += error
+    return black
+
+
+def floyd_dither(gray: np.ndarray, diffuse: bool = True) -> np.ndarray:
+    im = Image.fromarray(np.round(gray * 255).astype(np.uint8))
+    # dither=None would mean Floyd-Steinberg to Pillow, so the plain threshold needs Dither.NONE
+    return np.logical_not(np.asarray(im.convert("1", dither=Image.Dither.FLOYDSTEINBERG if diffuse else Image.Dither.NONE)))
+
+
+def dither(gray: np.ndarray, method: str) -> np.ndarray:
+    """
+    Turn gray levels (0 black to 1 white) into a boolean array, True for the pixels to ink black
+    """
+    if method == "floyd":
+        return floyd_dither(gray)
+    if method == "none":
+        return floyd_dither(gray, diffuse=False)
+    if method == "bayer":
+        return ordered_dither(gray, bayer_matrix())
+    if method == "clustered":
+        return ordered_dither(gray, clustered_dot_matrix())
+    if method == "bluenoise":
+        return ordered_dither(gray, blue_noise_matrix())
+    if method == "atkinson":
+        return atkinson_dither(gray)
+    raise ValueError(f"Unknown dither {method}! Choose between {', '.join(DITHER_METHODS)} and auto.")
+
+
+def visual_error(gray: np.ndarray, black: np.ndarray) -> float:
+    """
+    Root mean square difference between the blurred gray levels and the blurred bilevel image
+    """
+    return float(np.sqrt(np.mean((blur(gray) - blur(np.logical_not(black).astype(float))) ** 2)))
+
+
+def score_dithers(gray: np.ndarray, count_inputs, time_budget: float = DEFAULT_DITHER_BUDGET,
+                  methods: Optional[list[str]] = None) -> list[dict]:
+    """
+    Dither the image with every method and rank them by their normalized input count plus visual error.
+    count_inputs(black) must return the inputs needed to print the boolean black array.
+    Methods are tried in order until time_budget runs out; the ones left are not ranked.
+    """
+    deadline = time.monotonic() + time_budget
+    ranking = []
+    for method in methods or AUTO_DITHER_ORDER:
+        if len(ranking) > 0 and time.monotonic() >= deadline:
+            break
+        start = time.monotonic()
+        black = dither(gray, method)
+        ranking.append({'method': method,
+                        'black': black,
+                        'inputs': int(count_inputs(black)),
+                        'error': visual_error(gray, black),
+                        'seconds': time.monotonic() - start})
+
+    most_inputs = max(max(score['inputs'] for score in ranking), 1)
+    most_error = max(max(score['error'] for score in ranking), 1e-9)
+    for score in ranking:
+        score['score'] = score['inputs'] / most_inputs + DITHER_ERROR_WEIGHT * score['error'] / most_error
+    # Ties (e.g. images that are already bilevel) keep the usual dither
+    ranking.sort(key=lambda score: (score['score'], DITHER_METHODS.index(score['method'])))
+    return ranking
+
+
+def print_dither_ranking(ranking: list[dict]):
+    print(f"{'#':>3} {'dither':>9} {'inputs':>7} {'error':>6} {'score':>6} {'time':>7}")
+    for rank, score in enumerate(ranking, 1):
+        print(f"{rank:>3} {score['method']:>9} {score['inputs']:>7} {score['error']:>6.3f} {score['score']:>6.3f}"
+              f" {score['seconds']:>6.1f}s")
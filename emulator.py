@@ -0,0 +1,380 @@
+#!/bin/python
+
+import sys, getopt
+import re
+
+import numpy as np
+from PIL import Image
+
+# Values mirrored from Joystick.c
+ECHOES = 2
+OPTIONS_OFFSET = 1
+FIX_OFFSET = 40
+# The Switch polls the controller at 125Hz, which matches the ~30 minutes a full print takes
+REPORT_PERIOD = 0.008
+# Logical reports spent in SYNC_CONTROLLER and SYNC_POSITION before the first pixel
+SYNC_REPORTS = 352
+# Every cursor step takes a STOP state and a MOVE state, as in the firmware's own line sweeps
+REPORTS_PER_STEP = 2
+# Command steps, as (row, column) moves: up, left, down, right
+COMMAND_STEPS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+# Safety net for option combinations the state machine never finishes (e.g. vertical fix mode)
+DEFAULT_MAX_REPORTS = 3_000_000
+
+(SYNC_CONTROLLER, SYNC_POSITION, FILL_BLACK, FILL_BLACK_YSHIFT, FILL_BLACK_STOP_X, FILL_BLACK_STOP_Y,
+ STOP_X, STOP_Y, MOVE_X, MOVE_Y, VERTICAL_STOP_X, VERTICAL_STOP_Y, VERTICAL_MOVE_X, VERTICAL_MOVE_Y,
+ FIX_BUFFER, FIX_STOP_X, FIX_STOP_Y, FIX_MOVE_X, FIX_MOVE_Y, FIX_VERTICAL_STOP_X, FIX_VERTICAL_STOP_Y,
+ FIX_VERTICAL_MOVE_X, FIX_VERTICAL_MOVE_Y, ENDSAVE, DONE) = range(25)
+
+
+class PrintOptions:
+    """
+    Options of the first image byte, decoded the way CheckImageOptions decodes them
+    """
+    def __init__(self, options_byte: int):
+        self.cautiousoffset = 3 if options_byte & 1 << 0 else 0
+        self.opposite = bool(options_byte & 1 << 1)
+        self.slowmode = bool(options_byte & 1 << 2)
+        self.endsave = bool(options_byte & 1 << 3)
+        self.vertical = bool(options_byte & 1 << 4)
+        self.fix = bool(options_byte & 1 << 5)
+        self.sparse = bool(options_byte & 1 << 6)
+        # The firmware ignores bit 7, which only tells how the optimal command list is stored
+        self.compressed = bool(options_byte & 1 << 7)
+
+    def __repr__(self):
+        return ("PrintOptions(cautiousoffset={}, opposite={}, slowmode={}, endsave={}, vertical={}, fix={}, sparse={},"
+                " compressed={})".format(self.cautiousoffset, self.opposite, self.slowmode, self.endsave, self.vertical,
+                                         self.fix, self.sparse, self.compressed))
+
+
+class EmulationResult:
+    def __init__(self, options: PrintOptions, logical_reports: int, canvas: np.ndarray, finished: bool,
+                 report_period: float = REPORT_PERIOD):
+        self.options = options
+        self.logical_reports = logical_reports
+        self.reports = logical_reports * (1 + ECHOES)
+        self.seconds = self.reports * report_period
+        self.canvas = canvas
+        self.finished = finished
+
+
+def read_image_data(filename: str) -> np.ndarray:
+    """
+    Read the image_data bytes from a generated .c file, or from a raw binary file
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    if not filename.endswith(".c"):
+        return np.frombuffer(raw, dtype=np.uint8)
+    body = re.search(rb"image_data\[[^\]]*\][^=]*=\s*\{([^}]*)\}", raw)
+    if body is None:
+        raise ValueError(f"No image_data array found in {filename}!")
+    return np.array([int(token, 0) for token in body.group(1).split(b",") if token.strip()], dtype=np.uint8)
+
+
+def image_bits(image_data: np.ndarray) -> np.ndarray:
+    """
+    The 120x320 pixel bits stored after the option and fix bytes, 1 where Joystick.c reads a set bit
+    """
+    start = OPTIONS_OFFSET + FIX_OFFSET
+    return np.unpackbits(image_data[start:start + 4800], bitorder="little").reshape(120, 320)
+
+
+def emulate(image_data: np.ndarray, report_period: float = REPORT_PERIOD, max_reports: int = DEFAULT_MAX_REPORTS,
+            initial_canvas: np.ndarray = None) -> EmulationResult:
+    """
+    Replay GetNextReport from Joystick.c, one logical report (sent 1 + ECHOES times) per loop.
+    The canvas holds 1 for inked pixels: A inks the pixel under the cursor and B erases it,
+    SWITCH_LCLICK clears the canvas and the fill black phase of opposite mode leaves it all black.
+    """
+    data = np.asarray(image_data, dtype=np.uint8)
+    options = PrintOptions(int(data[0]))
+    data_list = data.tolist()
+    data_length = len(data_list)
+    bits = image_bits(data).reshape(-1).tolist() if data_length >= OPTIONS_OFFSET + FIX_OFFSET + 4800 else None
+
+    def read_bit(index: int, bit: int) -> bool:
+        # Out of range reads and negative shifts are undefined in C; they never ink here
+        if bit < 0 or not 0 <= index < data_length:
+            return False
+        return bool(data_list[index] >> bit & 1)
+
+    def pixel(x: int, y: int) -> bool:
+        if bits is not None and 0 <= x < 320 and 0 <= y < 120:
+            return bool(bits[y * 320 + x])
+        # C integer division and remainder truncate toward zero
+        quotient = int(x / 8)
+        return read_bit(quotient + y * 40 + OPTIONS_OFFSET + FIX_OFFSET, x - 8 * quotient)
+
+    canvas = np.zeros((120, 320), dtype=np.uint8) if initial_canvas is None else np.array(initial_canvas, dtype=np.uint8)
+    cautiousoffset, opposite, slowmode = options.cautiousoffset, options.opposite, options.slowmode
+    endsave, vertical, fix = options.endsave, options.vertical, options.fix
+    state = SYNC_CONTROLLER
+    report_count = xpos = ypos = blackfill = 0
+    fix_right_or_left = False
+    slowflip = inkturn = inkstopper = True
+    finished = False
+    max_logical_reports = max_reports // (1 + ECHOES)
+    logical_reports = 0
+
+    while logical_reports < max_logical_reports:
+        if not slowflip or not slowmode:
+            if state == DONE:
+                finished = True
+                break
+            elif state == STOP_X:
+                state = MOVE_X
+            elif state == MOVE_X:
+                if ypos % 2:
+                    xpos -= 1
+                else:
+                    xpos += 1
+                if 0 - cautiousoffset < xpos < 320 - 1 + cautiousoffset:
+                    state = STOP_X
+                else:
+                    xpos = 0 if ypos % 2 else 320 - 1
+                    state = STOP_Y
+            elif state == STOP_Y:
+                if ypos < 120 - 1:
+                    state = MOVE_Y
+                else:
+                    state = ENDSAVE if endsave else DONE
+            elif state == MOVE_Y:
+                ypos += 1
+                state = STOP_X
+            elif state == VERTICAL_STOP_Y:
+                state = VERTICAL_MOVE_Y
+            elif state == VERTICAL_MOVE_Y:
+                if xpos % 2:
+                    ypos -= 1
+                else:
+                    ypos += 1
+                if 0 - cautiousoffset < ypos < 120 - 1 + cautiousoffset:
+                    state = VERTICAL_STOP_Y
+                else:
+                    ypos = 0 if xpos % 2 else 120 - 1
+                    state = VERTICAL_STOP_X
+            elif state == VERTICAL_STOP_X:
+                if xpos < 320 - 1:
+                    state = VERTICAL_MOVE_X
+                else:
+                    state = ENDSAVE if endsave else DONE
+            elif state == VERTICAL_MOVE_X:
+                xpos += 1
+                state = VERTICAL_STOP_Y
+            elif state == SYNC_CONTROLLER:
+                if report_count > 100:
+                    report_count = 0
+                    state = SYNC_POSITION
+                report_count += 1
+            elif state == SYNC_POSITION:
+                if report_count >= 250:
+                    report_count = 0
+                    xpos = ypos = 0
+                    if fix:
+                        state = FIX_VERTICAL_STOP_Y if vertical else FIX_STOP_X
+                    elif opposite:
+                        state = FILL_BLACK_STOP_X
+                    else:
+                        inkstopper = False
+                        state = VERTICAL_STOP_Y if vertical else STOP_X
+                if (report_count == 75 or report_count == 150) and not fix:
+                    canvas[:] = 0  # Clear the screen
+                report_count += 1
+            elif state == FILL_BLACK_STOP_X:
+                state = FILL_BLACK
+            elif state == FILL_BLACK_STOP_Y:
+                state = FILL_BLACK_YSHIFT
+            elif state == FILL_BLACK:
+                if report_count <= 100:
+                    report_count += 1
+                elif 115 - 1 < report_count < 300:
+                    report_count += 1
+                elif report_count >= 300:
+                    blackfill = report_count = xpos = ypos = 0
+                    inkstopper = False
+                    canvas[:] = 1
+                    state = VERTICAL_STOP_Y if vertical else STOP_X
+                else:
+                    if ypos % 2:
+                        xpos -= 1
+                    else:
+                        xpos += 1
+                    if -1 < xpos < 125:
+                        state = FILL_BLACK_STOP_X
+                    else:
+                        xpos = 0 if ypos % 2 else 125 - 1
+                        ypos += 1
+                        state = FILL_BLACK_STOP_Y
+            elif state == FILL_BLACK_YSHIFT:
+                if report_count >= 115 - 1:
+                    report_count += 1
+                    state = FILL_BLACK_STOP_X
+                if blackfill < 9:
+                    state = FILL_BLACK_STOP_Y
+                    blackfill += 1
+                else:
+                    blackfill = 0
+                    report_count += 1
+                    state = FILL_BLACK_STOP_X
+            elif state == FIX_BUFFER or state == FIX_STOP_X:
+                if state == FIX_BUFFER:
+                    fix_right_or_left = not fix_right_or_left
+                # FIX_BUFFER falls through to FIX_STOP_X
+                state = MOVE_X
+            elif state == FIX_STOP_Y:
+                if ypos < 120 - 1:
+                    if read_bit(int(ypos / 8) + OPTIONS_OFFSET + FIX_OFFSET, ypos % 8):
+                        inkstopper = False
+                        state = FIX_STOP_X
+                    else:
+                        state = MOVE_Y
+                else:
+                    state = ENDSAVE if endsave else DONE
+            elif state == FIX_MOVE_X:
+                if fix_right_or_left:
+                    xpos -= 1
+                else:
+                    xpos += 1
+                if 0 - cautiousoffset < xpos < 320 - 1 + cautiousoffset:
+                    state = FIX_STOP_X
+                else:
+                    xpos = 0 if fix_right_or_left else 320 - 1
+                    inkstopper = True
+                    state = FIX_BUFFER
+            elif state == FIX_MOVE_Y:
+                ypos += 1
+                state = FIX_STOP_Y
+            elif state == ENDSAVE:
+                if report_count > 100:
+                    state = DONE
+                report_count += 1
+            # The other fix states have no case in Joystick.c and keep the state as it is
+
+        # Inking
+        if slowflip or not slowmode:
+            if not inkstopper and 0 <= xpos < 320 and 0 <= ypos < 120:
+                if fix:
+                    canvas[ypos, xpos] = pixel(xpos, ypos)
+                else:
+                    canvas[ypos, xpos] = not opposite
+            inkturn = True
+        slowflip = False
+
+        if not inkturn and slowmode:
+            # Checks if the current pixel should be inked or not
+            if pixel(xpos, ypos) != opposite:
+                slowflip = True
+        inkturn = False
+        logical_reports += 1
+
+    return EmulationResult(options, logical_reports, canvas, finished, report_period)
+
+
+def clamped_walk(steps: np.ndarray, start: int, size: int) -> np.ndarray:
+    """
+    Positions along one axis of a walk that stops against 0 and size - 1, like the cursor against the canvas edges.
+    Until the walk reaches the other edge, its positions are the running sum minus how far it went past
+    the edge it last stopped against, so only every switch from one edge to the other costs a pass.
+    """
+    steps = np.asarray(steps, dtype=np.int64)
+    positions = np.empty(len(steps), dtype=np.int64)
+    i, current, lower = 0, start, True
+    while i < len(steps):
+        walk = current + np.cumsum(steps[i:])
+        if lower:
+            walk -= np.minimum(np.minimum.accumulate(walk), 0)
+            past = np.flatnonzero(walk > size - 1)
+        else:
+            walk -= np.maximum(np.maximum.accumulate(walk) - (size - 1), 0)
+            past = np.flatnonzero(walk < 0)
+        if len(past) == 0:
+            positions[i:] = walk
+            break
+        first = past[0]
+        positions[i:i + first] = walk[:first]
+        current = size - 1 if lower else 0
+        positions[i + first] = current
+        i, lower = i + first + 1, not lower
+    return positions
+
+
+def replay_commands(commands: np.ndarray) -> np.ndarray:
+    """
+    The (n + 1, 2) array of cursor positions (row, column) along a command list, from the top left corner
+    """
+    steps = np.array(COMMAND_STEPS)[np.asarray(commands, dtype=np.intp)].reshape(-1, 2)
+    positions = np.zeros((len(steps) + 1, 2), dtype=np.int64)
+    positions[1:, 0] = clamped_walk(steps[:, 0], 0, 120)
+    positions[1:, 1] = clamped_walk(steps[:, 1], 0, 320)
+    return positions
+
+
+def emulate_route(image_data: np.ndarray, commands: np.ndarray, report_period: float = REPORT_PERIOD,
+                  initial_canvas: np.ndarray = None) -> EmulationResult:
+    """
+    Reference emulation of printing a command route instead of the line sweeps, after the usual sync.
+    The cursor starts in the top left corner and stops against the canvas edges. Every pixel it reaches is inked
+    when the image holds it black, or set to the image (inked or erased) in fix mode.
+    Each step takes a STOP and a MOVE report, and slowmode adds one report per pixel inked.
+    """
+    data = np.asarray(image_data, dtype=np.uint8)
+    options = PrintOptions(int(data[0]))
+    bits = image_bits(data)
+    canvas = np.zeros((120, 320), dtype=np.uint8) if initial_canvas is None else np.array(initial_canvas, dtype=np.uint8)
+
+    visits = replay_commands(commands)
+    visited = np.zeros((120, 320), dtype=bool)
+    ys, xs = visits.T
+    visited[ys, xs] = True
+    inked = visited if options.fix else visited & (bits == 1)
+    canvas[inked] = bits[inked]
+
+    # Every visit of a pixel to ink presses A again
+    presses = len(visits) if options.fix else int(np.count_nonzero(bits[ys, xs]))
+    logical_reports = SYNC_REPORTS + REPORTS_PER_STEP * len(commands) + 1 + (presses if options.slowmode else 0)
+    return EmulationResult(options, logical_reports, canvas, True, report_period)
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hp:c:", ["help", "period=", "canvas="])
+    report_period = REPORT_PERIOD
+    canvas_filename = None
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage()
+            sys.exit()
+        elif opt in ['-p', '--period']:
+            report_period = float(arg) / 1000
+        elif opt in ['-c', '--canvas']:
+            canvas_filename = arg
+
+    image_data = read_image_data(args[0])
+    result = emulate(image_data, report_period)
+    minutes, seconds = divmod(result.seconds, 60)
+    print(f"{args[0]}: {result.options}")
+    print(f"USB reports: {result.reports} ({result.logical_reports} without echoes)")
+    print(f"Estimated print time: {int(minutes)}m {seconds:.1f}s")
+    if not result.finished:
+        print("WARNING: The print never finished; the state machine got stuck with these options!")
+    wrong_pixels = np.sum(result.canvas != image_bits(image_data))
+    print(f"Pixels differing from the image: {wrong_pixels}")
+    if canvas_filename is not None:
+        Image.fromarray((1 - result.canvas) * 255).convert("1").save(canvas_filename)
+        print(f"Emulated canvas saved to {canvas_filename}!")
+
+
+def usage():
+    print("To emulate printing a generated file: emulator.py [-options] <splat_image.c>")
+    print("\n--help [-h]: Show this help list")
+    print("--period [-p] <ms>: Milliseconds between USB reports (default: 8)")
+    print("--canvas [-c] <image.png>: Save the canvas the print would produce")
+
+
+if __name__ == "__main__":
+    if len(sys.argv[1:]) == 0:
+        usage()
+        sys.exit
+    else:
+        main(sys.argv[1:])
@@ -1,17 +1,19 @@
 #Original file from Splatplost (https://github.com/Victrid/splatplost), written by Victrid (Jiang Weihao)
 
 import sys
+import time
+from typing import Iterator, Optional, Union
 
 import numpy as np
 from PIL import Image
-from scipy.spatial.distance import cityblock as manhattan_distance
-from skimage import measure
-from tsp_solver.greedy_numpy import solve_tsp as tsp_solver_greedy
 
-from tsp_solver_dp import solve_tsp_dynamic_programming as tsp_solver_dp
+import profiler
+from tsp_portfolio import DEFAULT_BLOCK_BUDGET, solve_open_path
 
 
 class ResetPosition:
+    __slots__ = ("left", "up")
+
     def __init__(self, left: bool, up: bool):
         self.left = left
         self.up = up
@@ -33,95 +35,148 @@ def is_coordinate_valid(x: int, y: int) -> bool:
     return 0 <= x < 120 and 0 <= y < 320
 
 
+RESET_CORNERS = np.array([(0, 0), (119, 0), (0, 319), (119, 319)])
+
+
+def find_nearest_reset_corners(points: np.ndarray) -> np.ndarray:
+    """
+    Index in RESET_CORNERS of the corner nearest to every point of an (n, 2) array
+    """
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    return np.abs(points[:, np.newaxis, :] - RESET_CORNERS[np.newaxis, :, :]).sum(axis=2).argmin(axis=1)
+
+
+def find_nearest_reset_positions(points: np.ndarray) -> list[ResetPosition]:
+    """
+    Find the nearest reset position for every point of an (n, 2) array at once
+    """
+    # RESET_CORNERS lists the left corners first, and the upper corner first on each side
+    return [ResetPosition(t // 2 == 0, t % 2 == 0) for t in find_nearest_reset_corners(points).tolist()]
+
+
 def find_nearest_reset_position(point: np.ndarray) -> ResetPosition:
-    t = np.array([manhattan_distance(point, (0, 0)),
-                  manhattan_distance(point, (119, 0)),
-                  manhattan_distance(point, (0, 319)),
-                  manhattan_distance(point, (119, 319))]
-                 ).argmin()
-
-    return ResetPosition(t % 2 == 0, t // 2 == 0)
-
-
-def goto_next_point(current_point, next_point, draw=True):
-    def march(a, b):
-        output_q = []
-        ver = b[0] - a[0]
-        hor = b[1] - a[1]
-        if ver > 0:
-            output_q += ["down"] * ver
-        else:
-            output_q += ["up"] * (-ver)
-        if hor > 0:
-            output_q += ["right"] * hor
-        else:
-            output_q += ["left"] * (-hor)
-        return output_q
+    return find_nearest_reset_positions(point)[0]
+
+
+UP, LEFT, DOWN, RIGHT = 0, 1, 2, 3
+
+# A reset pushes the cursor past the corner: half the canvas width, then half its height
+RESET_SEGMENTS = {
+    "lu": (np.array([LEFT, UP], dtype=np.uint8), np.array([320 // 2, 120 // 2])),
+    "ld": (np.array([LEFT, DOWN], dtype=np.uint8), np.array([320 // 2, 120 // 2])),
+    "ru": (np.array([RIGHT, UP], dtype=np.uint8), np.array([320 // 2, 120 // 2])),
+    "rd": (np.array([RIGHT, DOWN], dtype=np.uint8), np.array([320 // 2, 120 // 2])),
+}
+
 
-    return march(current_point, next_point)
+# Points of the planner fit in 16 bits, so a visit takes 4 bytes and its opcode 1
+POINT_DTYPE = np.int16
+# Opcode of a point visited by moving vertically, then horizontally; a reset to the corner RESET_CORNERS[i] is i + 1
+VISIT = 0
+# Commands and lengths of the two segments of a reset, per opcode
+RESET_COMMANDS = ["lu", "ld", "ru", "rd"]
+OPCODE_DIRECTIONS = np.array([[DOWN, RIGHT]] + [RESET_SEGMENTS[command][0] for command in RESET_COMMANDS],
+                             dtype=np.uint8)
+RESET_LENGTHS = RESET_SEGMENTS["lu"][1].astype(POINT_DTYPE)
 
 
-def generate_order(seq):
-    current = (0, 0)
-    command_list = []
+class VisitList:
+    """
+    The whole visit sequence of a route as two parallel arrays: the (n, 2) POINT_DTYPE points and their uint8 opcodes.
+    A reset is a single entry holding the corner it ends in.
+    """
+    __slots__ = ("points", "opcodes")
+
+    def __init__(self, points: np.ndarray, opcodes: Optional[np.ndarray] = None):
+        self.points = np.asarray(points, dtype=POINT_DTYPE).reshape(-1, 2)
+        self.opcodes = (np.zeros(len(self.points), dtype=np.uint8) if opcodes is None
+                        else np.asarray(opcodes, dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + self.opcodes.nbytes
+
+    @classmethod
+    def from_routes(cls, routes: list[np.ndarray], resets: list[bool]) -> "VisitList":
+        """
+        Visit the (k, 2) routes one after the other, resetting to the corner nearest the end of the previous route
+        before those where resets is set
+        """
+        if len(routes) == 0:
+            return cls(np.empty((0, 2)))
+        before_reset = [route[-1] for route, reset in zip(routes[:-1], resets[1:]) if reset]
+        corners = iter(find_nearest_reset_corners(np.array(before_reset)).tolist())
+        points, opcodes = [], []
+        for route, reset in zip(routes, resets):
+            if reset:
+                corner = next(corners)
+                points.append(RESET_CORNERS[corner][np.newaxis, :])
+                opcodes.append(np.array([corner + 1], dtype=np.uint8))
+            points.append(route)
+            opcodes.append(np.full(len(route), VISIT, dtype=np.uint8))
+        return cls(np.concatenate(points), np.concatenate(opcodes))
+
+    @classmethod
+    def from_sequence(cls, seq) -> "VisitList":
+        """
+        Convert a sequence of reset positions, (k, 2) arrays of points and single points
+        """
+        points, opcodes = [], []
+        for chunk in iterate_visit_chunks(seq):
+            if isinstance(chunk, ResetPosition):
+                corner = RESET_COMMANDS.index(chunk.get_command())
+                points.append(np.array([chunk.get_position()]))
+                opcodes.append(np.array([corner + 1], dtype=np.uint8))
+            else:
+                points.append(np.asarray(chunk).reshape(-1, 2))
+                opcodes.append(np.full(len(points[-1]), VISIT, dtype=np.uint8))
+        if len(points) == 0:
+            return cls(np.empty((0, 2)))
+        return cls(np.concatenate(points), np.concatenate(opcodes))
+
+    def segments(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The run-length segments of the route, as arrays of directions and of their repeat counts.
+        Every point is reached by moving vertically first, then horizontally, from the top left corner.
+        """
+        steps = np.diff(self.points, axis=0, prepend=np.zeros((1, 2), dtype=POINT_DTYPE))
+        visits = (self.opcodes == VISIT)[:, np.newaxis]
+        directions = OPCODE_DIRECTIONS[self.opcodes]
+        directions[visits[:, 0] & (steps[:, 0] < 0), 0] = UP
+        directions[visits[:, 0] & (steps[:, 1] < 0), 1] = LEFT
+        counts = np.where(visits, np.abs(steps), RESET_LENGTHS)
+        return directions.reshape(-1), counts.reshape(-1)
+
+
+def iterate_visit_chunks(seq) -> Iterator[Union[ResetPosition, np.ndarray]]:
+    """
+    Group the visit sequence into reset positions and (k, 2) arrays of consecutive points.
+    The sequence may hold single points as well as (k, 2) arrays of points.
+    """
+    points = []
     for item in seq:
-        if isinstance(item, ResetPosition):
-            command_list += [item.get_command()]
-            current = item.get_position()
+        if isinstance(item, ResetPosition) or np.ndim(item) == 2:
+            if points:
+                yield np.array(points)
+                points = []
+            yield item
         else:
-            command_list += goto_next_point(current, item)
-            current = item
-        pass
-
-    bin_command_list = []
-    for command in command_list:
-        cv = -1
-        match command:
-            case 'up': 
-                cv = 0
-                bin_command_list.append(cv)
-            case 'left':
-                cv = 1
-                bin_command_list.append(cv)
-            case 'down':
-                cv = 2
-                bin_command_list.append(cv)
-            case 'right':
-                cv = 3
-                bin_command_list.append(cv)
-            case 'lu':
-                for i in range(int(320/2)):
-                    cv = 1
-                    bin_command_list.append(cv)
-                for i in range(int(120/2)):
-                    cv = 0
-                    bin_command_list.append(cv)
-            case 'ld':
-                for i in range(int(320/2)):
-                    cv = 1
-                    bin_command_list.append(cv)
-                for i in range(int(120/2)):
-                    cv = 2
-                    bin_command_list.append(cv)
-            case 'ru':
-                for i in range(int(320/2)):
-                    cv = 3
-                    bin_command_list.append(cv)
-                for i in range(int(120/2)):
-                    cv = 0
-                    bin_command_list.append(cv)
-            case 'rd':
-                for i in range(int(320/2)):
-                    cv = 3
-                    bin_command_list.append(cv)
-                for i in range(int(120/2)):
-                    cv = 2
-                    bin_command_list.append(cv)
-            case _:
-                cv = -1
-                bin_command_list.append(cv)
-
-    return bin_command_list
+            points.append(item)
+    if points:
+        yield np.array(points)
+
+
+def generate_order(seq) -> np.ndarray:
+    """
+    Generate the uint8 array of 2-bit commands (0: up, 1: left, 2: down, 3: right) visiting the sequence,
+    a VisitList or a sequence VisitList.from_sequence converts
+    """
+    visits = seq if isinstance(seq, VisitList) else VisitList.from_sequence(seq)
+    directions, counts = visits.segments()
+    return np.repeat(directions, counts)
 
 
 def load_images(input_file_name: str) -> np.ndarray:
@@ -149,73 +204,178 @@ def get_label(image: np.ndarray) -> tuple[np.ndarray, int]:
     """
     Get connected components of the image and return the label
     """
+    # Imported here, like the greedy solver, so that converting without planning only needs Pillow and NumPy
+    from skimage import measure
     label = measure.label(image, connectivity=1, background=0)
     label_count = np.max(label)
     return label, label_count
 
 
-def generate_dense_visit(labeled_image: np.ndarray, label_selector: int, image_offset: np.ndarray) -> list[np.ndarray]:
+# Sweeps tried for every label: (column by column, first line swept backwards).
+# Sweeping from the last line is the reverse of one of these, so it costs as many moves.
+SWEEP_VARIANTS = [(False, False), (False, True), (True, False), (True, True)]
+# Most rounds spent choosing the sweeps of the labels once their order is known
+SWEEP_PASSES = 4
+
+
+def serpentine_order(points: np.ndarray, labels: np.ndarray, vertical: bool, backwards: bool) -> np.ndarray:
     """
-    Generate a list of points that dense label is visited
+    The order of the points (sorted by label) sweeping every label line by line, alternating direction.
+    Lines are rows going right first, or columns going down first when vertical; backwards flips the first direction.
     """
-    to_be_visited = (labeled_image == label_selector)
-    current_row = np.argwhere(to_be_visited)[0][0]
-    go_right = True
-    visit_list = []
-    current_list = []
-    for item in np.argwhere(to_be_visited):
-        if item[0] == current_row:
-            current_list.append(item + image_offset)
-        else:
-            visit_list += current_list if go_right else reversed(current_list)
-            current_row = item[0]
-            go_right = not go_right
-            current_list = [item + image_offset]
-    visit_list += current_list if go_right else reversed(current_list)
-    return visit_list
-
-
-def get_entry_exit_point_min_distance(entry_exit_point: list[tuple[np.ndarray, np.ndarray]], greedy: int = 3) -> list[
-    int]:
-    distance_matrix = np.zeros((len(entry_exit_point), len(entry_exit_point)))
-    for i in range(len(entry_exit_point)):
-        for j in range(len(entry_exit_point)):
-            if i == j or j == 0:
-                continue
-            distance_matrix[i][j] = manhattan_distance(entry_exit_point[i][1], entry_exit_point[j][0])
-    if greedy != -1:
-        permutation = tsp_solver_greedy(distance_matrix, optim_steps=greedy, endpoints=(0, None))
-    else:
-        permutation, _ = tsp_solver_dp(distance_matrix)
-    return permutation
+    across, along = (points[:, 1], points[:, 0]) if vertical else (points[:, 0], points[:, 1])
+    order = np.lexsort((along, across, labels))
+    label_start = np.ones(len(points), dtype=bool)
+    label_start[1:] = labels[order][1:] != labels[order][:-1]
+    line_start = label_start.copy()
+    line_start[1:] |= across[order][1:] != across[order][:-1]
+    line_number = np.cumsum(line_start)
+    line_rank = line_number - np.maximum.accumulate(np.where(label_start, line_number, 0))
+    along_key = np.where((line_rank % 2 == 0) != backwards, along[order], -along[order])
+    return order[np.lexsort((along_key, across[order], labels[order]))]
+
+
+def sweep_variants(labeled_image: np.ndarray, image_offset: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sweep every label of the image in each of SWEEP_VARIANTS, in one pass over the labeled image.
+    Returns the (variants, n, 2) array of the points in the order of every variant, grouped by label in label order,
+    the index of the first point of every label, and the (variants, labels) array of the moves every sweep takes.
+    """
+    points = np.argwhere(labeled_image > 0)
+    labels = labeled_image[points[:, 0], points[:, 1]]
+    # Every order keeps the labels sorted, so a label fills the same positions in all of them
+    orders = np.stack([serpentine_order(points, labels, vertical, backwards) for vertical, backwards in SWEEP_VARIANTS])
+    sorted_labels = labels[orders[0]]
+    label_start = np.ones(len(points), dtype=bool)
+    label_start[1:] = sorted_labels[1:] != sorted_labels[:-1]
+    starts = np.flatnonzero(label_start)
+
+    sweeps = points[orders] + image_offset
+    moves = np.abs(np.diff(sweeps, axis=1)).sum(axis=2)
+    moves[:, starts[1:] - 1] = 0  # Leaving a label for the next one isn't part of its sweep
+    costs = np.add.reduceat(np.pad(moves, ((0, 0), (0, 1))), starts, axis=1) if len(points) > 0 else moves
+    return sweeps, starts, costs
+
+
+def orient_sweeps(sweeps: np.ndarray, starts: np.ndarray, costs: np.ndarray, permutation: list[int]) -> list[np.ndarray]:
+    """
+    Choose the sweep of every label visited in the permutation order, among the variants and their reverses,
+    counting the moves of the sweep and the travel from the label before and to the label after.
+    Starts from the sweeps with the fewest moves, then improves the labels at even and odd positions in turn
+    until none changes, for at most SWEEP_PASSES rounds; the total only ever gets shorter.
+    Returns the points of every label, in visiting order.
+    """
+    permutation = np.asarray(permutation, dtype=int)
+    ends = np.append(starts[1:], sweeps.shape[1]) - 1
+    first, last = sweeps[:, starts[permutation]], sweeps[:, ends[permutation]]
+    # Variants past len(SWEEP_VARIANTS) are the reverses of the others
+    entries, exits = np.concatenate([first, last]), np.concatenate([last, first])
+    moves = np.tile(costs[:, permutation], (2, 1))
+    count = len(permutation)
+    choice = costs[:, permutation].argmin(axis=0)
+    for _ in range(SWEEP_PASSES):
+        changed = False
+        for parity in (0, 1):
+            positions = np.arange(parity, count, 2)
+            total = moves[:, positions].copy()
+            before = positions > 0
+            previous = positions[before] - 1
+            total[:, before] += np.abs(entries[:, positions[before]] - exits[choice[previous], previous]).sum(axis=2)
+            after = positions < count - 1
+            following = positions[after] + 1
+            total[:, after] += np.abs(exits[:, positions[after]] - entries[choice[following], following]).sum(axis=2)
+            current = choice[positions]
+            best = total.argmin(axis=0)
+            columns = np.arange(len(positions))
+            best = np.where(total[best, columns] < total[current, columns], best, current)
+            changed = changed or bool((best != current).any())
+            choice[positions] = best
+        if not changed:
+            break
+    variants = len(SWEEP_VARIANTS)
+    return [sweeps[variant % variants, starts[label]:ends[label] + 1][::-1 if variant >= variants else 1]
+            for label, variant in zip(permutation.tolist(), choice.tolist())]
+
+
+def get_distance_matrix(entry_exit_point: list[tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    """
+    Manhattan distance from the exit point of every route (rows) to the entry point of every route (columns).
+    The diagonal and the first column are 0, so that the route can end anywhere.
+    """
+    if len(entry_exit_point) == 0:
+        return np.zeros((0, 0))
+    entries = np.array([t[0] for t in entry_exit_point]).reshape(-1, 2)
+    exits = np.array([t[1] for t in entry_exit_point]).reshape(-1, 2)
+    distance_matrix = np.abs(exits[:, np.newaxis, :] - entries[np.newaxis, :, :]).sum(axis=2).astype(float)
+    np.fill_diagonal(distance_matrix, 0)
+    distance_matrix[:, 0] = 0
+    return distance_matrix
+
+
+def plan_block_visit(image_block: np.ndarray, image_offset: np.ndarray, block_budget: float = DEFAULT_BLOCK_BUDGET,
+                     image_deadline: Optional[float] = None) -> tuple[np.ndarray, bool]:
+    """
+    Generate the (n, 2) array of points visiting every dense label of the block.
+    Neighbouring pixels of different values are labeled apart. partition.py gives every component its own value,
+    so the pieces of a component split at the region borders stay apart.
+    The labels are ordered by the TSP portfolio for at most block_budget seconds, and not past image_deadline
+    (a time.monotonic() value shared by the blocks of an image).
+    Returns the points and whether the order search finished rather than running out of time.
+    """
+    deadline = time.monotonic() + block_budget
+    if image_deadline is not None:
+        deadline = min(deadline, image_deadline)
+    with profiler.block_step("label"):
+        label, label_count = get_label(image_block)
+    if label_count == 0:
+        return np.empty((0, 2), dtype=POINT_DTYPE), True
+    sweeps, starts, costs = sweep_variants(label, image_offset)
+    # The TSP sees the entry and exit points of the sweeps with the fewest moves
+    variant = costs.argmin(axis=0)
+    ends = np.append(starts[1:], sweeps.shape[1]) - 1
+    offset_entry_exit_point = list(zip(sweeps[variant, starts], sweeps[variant, ends]))
+    with profiler.block_step("tsp"):
+        result = solve_open_path(get_distance_matrix(offset_entry_exit_point), deadline)
+    profiler.note_block(components=int(label_count), tsp_nodes=len(offset_entry_exit_point), solver=result.solver,
+                        complete=result.complete)
+    return np.concatenate(orient_sweeps(sweeps, starts, costs, result.permutation)).astype(POINT_DTYPE), result.complete
+
+
+def generate_block_visit(image_block: np.ndarray, image_offset: np.ndarray) -> np.ndarray:
+    """
+    Generate the (n, 2) array of points visiting every dense label of the block
+    """
+    return plan_block_visit(image_block, image_offset)[0]
 
 
-def generate_block_visit(image_block: np.ndarray, image_offset: np.ndarray) -> list[np.ndarray]:
+def compute_difficulties(image, output) -> tuple[int, int]:
     """
-    Generate a list of points that dense label is visited
+    Get the original and current difficulty of printing the image.
+    Without an optimal output, the current difficulty is the original one.
     """
-    label, label_count = get_label(image_block)
-    if label_count == 0:
-        return []
-    internal_routes = [generate_dense_visit(label, label_idx, image_offset) for label_idx in
-                       range(1, label_count + 1)]
-    offset_entry_exit_point = [(t[0], t[-1]) for t in internal_routes]
-    arrangement = get_entry_exit_point_min_distance(offset_entry_exit_point, greedy=16)
-    visit_list = []
-    for i in arrangement:
-        visit_list += internal_routes[i]
-    return visit_list
-
-
-def summarize_difficulties(image, output):
     original_difficulty = 2 * np.sum(image) + np.sum(image == 0)
+    if output is None:
+        return original_difficulty, original_difficulty
     if np.sum(image == 1) > np.sum(image == 0):
         current_difficulty = len(output) + np.sum(image == 0)
     else:
         current_difficulty = len(output) + np.sum(image == 1)
+    return original_difficulty, current_difficulty
+
+
+def summarize_difficulties(image, output, baseline_length=None):
+    original_difficulty, current_difficulty = compute_difficulties(image, output)
     print("Original difficulty: {}, Current difficulty: {}, Reduced: {}%".format(
             original_difficulty,
             current_difficulty,
             round((original_difficulty - current_difficulty) / original_difficulty * 100, 4)
             )
-        )
\ No newline at end of file
+        )
+    if baseline_length is not None:
+        print("Route commands before block optimization: {}, after: {}, Reduced: {}%".format(
+                baseline_length,
+                len(output),
+                round((baseline_length - len(output)) / max(baseline_length, 1) * 100, 4)
+                )
+            )
+    return original_difficulty, current_difficulty
@@ -0,0 +1,180 @@
+import numpy as np
+
+from generate_route import divide_image, get_label
+
+PARTITIONS = ["adaptive", "grid"]
+# The quadtree only shortens the routes by about 1% and plans slower, so the fixed grid stays the default
+DEFAULT_PARTITION = "grid"
+# Most components a region may hold, so that its TSP stays quick to solve
+MAX_REGION_COMPONENTS = 128
+# Most inked pixels a region may hold, so that its route stays about as long as the reset interval
+MAX_REGION_PIXELS = 3200
+# Regions aren't split below this side
+MIN_REGION_SIDE = 8
+# Components spanning more than this are cut at the region borders, like on the fixed grid,
+# since sweeping a large ring or tangle line by line would cross it on every line
+MAX_COMPONENT_SIDE = 40
+
+
+class InkDensity:
+    """
+    Component and pixel counts of any rectangle of the image, from summed-area tables.
+    Components larger than MAX_COMPONENT_SIDE are first cut into pieces on the fixed grid,
+    then every component or piece counts where the centre of its bounding box lies.
+    """
+    def __init__(self, image: np.ndarray):
+        label, count = get_label(image)
+        self.units, count = self.cut_large_components(image, label, count)
+        ys, xs = np.nonzero(self.units)
+        units = self.units[ys, xs] - 1
+        top, left = np.full(count, image.shape[0]), np.full(count, image.shape[1])
+        bottom, right = np.zeros(count, dtype=int), np.zeros(count, dtype=int)
+        np.minimum.at(top, units, ys)
+        np.minimum.at(left, units, xs)
+        np.maximum.at(bottom, units, ys)
+        np.maximum.at(right, units, xs)
+        self.anchors = np.stack([(top + bottom) // 2, (left + right) // 2], axis=1)
+
+        anchor_counts = np.zeros(image.shape, dtype=int)
+        anchor_pixels = np.zeros(image.shape, dtype=int)
+        np.add.at(anchor_counts, (self.anchors[:, 0], self.anchors[:, 1]), 1)
+        np.add.at(anchor_pixels, (self.anchors[:, 0], self.anchors[:, 1]), np.bincount(units, minlength=count))
+        self.count_table = summed_area_table(anchor_counts)
+        self.pixel_table = summed_area_table(anchor_pixels)
+
+    @staticmethod
+    def cut_large_components(image: np.ndarray, label: np.ndarray, count: int) -> tuple[np.ndarray, int]:
+        """
+        Relabel the image so that components spanning more than MAX_COMPONENT_SIDE become one unit per grid cell
+        """
+        if count == 0:
+            return label, 0
+        ys, xs = np.nonzero(label)
+        labels = label[ys, xs]
+        top, bottom = np.full(count + 1, image.shape[0]), np.zeros(count + 1, dtype=int)
+        left, right = np.full(count + 1, image.shape[1]), np.zeros(count + 1, dtype=int)
+        np.minimum.at(top, labels, ys)
+        np.maximum.at(bottom, labels, ys)
+        np.minimum.at(left, labels, xs)
+        np.maximum.at(right, labels, xs)
+        large = (bottom - top >= MAX_COMPONENT_SIDE) | (right - left >= MAX_COMPONENT_SIDE)
+        if not large[1:].any():
+            return label, count
+        # Neighbouring pixels of equal value are labeled together, so every grid cell gets its own value
+        cells = (np.arange(image.shape[0])[:, np.newaxis] // MAX_COMPONENT_SIDE * image.shape[1]
+                 + np.arange(image.shape[1])[np.newaxis, :] // MAX_COMPONENT_SIDE + 2)
+        values = np.where(large[label], cells, np.where(label > 0, 1, 0))
+        return get_label(values)
+
+    def counts(self, region: tuple[int, int, int, int]) -> tuple[int, int]:
+        """
+        Components and inked pixels of the region (y, x, height, width)
+        """
+        return rectangle_sum(self.count_table, region), rectangle_sum(self.pixel_table, region)
+
+    def fits(self, region: tuple[int, int, int, int]) -> bool:
+        components, pixels = self.counts(region)
+        return components <= MAX_REGION_COMPONENTS and pixels <= MAX_REGION_PIXELS
+
+    def region_block(self, region: tuple[int, int, int, int]) -> tuple[tuple[int, int], np.ndarray]:
+        """
+        The offset and pixels of the smallest block holding every component and piece of the region,
+        even past its borders. Every one of them gets its own value, so that labeling the block
+        doesn't join the pieces of a large component back together.
+        """
+        y, x, height, width = region
+        inside = ((self.anchors[:, 0] >= y) & (self.anchors[:, 0] < y + height)
+                  & (self.anchors[:, 1] >= x) & (self.anchors[:, 1] < x + width))
+        mask = np.isin(self.units, np.flatnonzero(inside) + 1)
+        rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        top, left = rows[0], columns[0]
+        units = np.where(mask, self.units, 0)[top:rows[-1] + 1, left:columns[-1] + 1]
+        block = np.searchsorted(np.union1d(0, units), units)
+        return (int(top), int(left)), block
+
+
+def summed_area_table(values: np.ndarray) -> np.ndarray:
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=int)
+    table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def rectangle_sum(table: np.ndarray, region: tuple[int, int, int, int]) -> int:
+    y, x, height, width = region
+    return int(table[y + height, x + width] - table[y, x + width] - table[y + height, x] + table[y, x])
+
+
+def split_region(region: tuple[int, int, int, int]) -> list[tuple[int, int, int, int]]:
+    """
+    Quadrants of the region, or halves when it's more than twice as long one way or the other can't be split
+    """
+    y, x, height, width = region
+    split_rows = height >= 2 * MIN_REGION_SIDE and 2 * height > width
+    split_columns = width >= 2 * MIN_REGION_SIDE and 2 * width > height
+    if not split_rows and not split_columns:
+        split_rows, split_columns = height >= 2 * MIN_REGION_SIDE, width >= 2 * MIN_REGION_SIDE
+    rows = [(y, height // 2), (y + height // 2, height - height // 2)] if split_rows else [(y, height)]
+    columns = [(x, width // 2), (x + width // 2, width - width // 2)] if split_columns else [(x, width)]
+    return [(row, column, row_height, column_width) for row, row_height in rows for column, column_width in columns]
+
+
+def merge_regions(regions: list[tuple[int, int, int, int]], density: InkDensity) -> list[tuple[int, int, int, int]]:
+    """
+    Merge regions sharing a whole side, as long as the merged region still fits
+    """
+    merged = True
+    while merged:
+        merged = False
+        for i, (y, x, height, width) in enumerate(regions):
+            for j, (other_y, other_x, other_height, other_width) in enumerate(regions[i + 1:], i + 1):
+                if y == other_y and height == other_height and (x + width == other_x or other_x + other_width == x):
+                    union = (y, min(x, other_x), height, width + other_width)
+                elif x == other_x and width == other_width and (y + height == other_y or other_y + other_height == y):
+                    union = (min(y, other_y), x, height + other_height, width)
+                else:
+                    continue
+                if density.fits(union):
+                    regions = regions[:i] + [union] + regions[i + 1:j] + regions[j + 1:]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def partition_regions(region: tuple[int, int, int, int], density: InkDensity) -> list[tuple[int, int, int, int]]:
+    """
+    Split the region until every part fits, then merge back the neighbouring parts that fit together.
+    Regions without ink are left out.
+    """
+    components, _ = density.counts(region)
+    if components == 0:
+        return []
+    children = split_region(region)
+    if density.fits(region) or len(children) == 1:
+        return [region]
+    regions = [part for child in children for part in partition_regions(child, density)]
+    return merge_regions(regions, density)
+
+
+def divide_image_adaptive(image: np.ndarray) -> list[tuple[tuple[int, int], np.ndarray]]:
+    """
+    Divide the image into regions holding at most MAX_REGION_COMPONENTS components and MAX_REGION_PIXELS pixels,
+    split as a quadtree where the ink is dense and left large where it's sparse.
+    Components smaller than MAX_COMPONENT_SIDE are never split between regions.
+    Returns (offset, block) pairs like divide_image, without the empty blocks.
+    """
+    density = InkDensity(image)
+    regions = partition_regions((0, 0) + image.shape, density)
+    return [density.region_block(region) for region in regions]
+
+
+def divide_ink(image: np.ndarray, partition: str = DEFAULT_PARTITION) -> list[tuple[tuple[int, int], np.ndarray]]:
+    """
+    Divide the ink array into the blocks planned separately, with the adaptive quadtree or the fixed 40x40 grid
+    """
+    if partition == "adaptive":
+        return divide_image_adaptive(image)
+    if partition == "grid":
+        return divide_image(image)
+    raise ValueError(f"Unknown partition {partition}! Choose between {', '.join(PARTITIONS)}.")
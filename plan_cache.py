@@ -0,0 +1,156 @@
+import hashlib
+import os
+import struct
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from generate_route import POINT_DTYPE
+from partition import DEFAULT_PARTITION
+
+# Bump when the planner changes, so plans made by an older version are not reused
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "splat-printer")
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+PLAN_MAGIC = b"SPPL"
+BLOCK_MAGIC = b"SPBK"
+# Magic, command count, baseline command count, original difficulty, current difficulty
+PLAN_HEADER = struct.Struct("<4sIIII")
+# Magic, point count
+BLOCK_HEADER = struct.Struct("<4sI")
+
+
+class CachedPlan:
+    def __init__(self, commands: np.ndarray, baseline_cost: int, original_difficulty: int, current_difficulty: int):
+        self.commands = commands
+        self.baseline_cost = baseline_cost
+        self.original_difficulty = original_difficulty
+        self.current_difficulty = current_difficulty
+
+
+def _pack_commands(commands: np.ndarray) -> bytes:
+    commands = np.asarray(commands, dtype=np.uint8) & 0x3
+    commands = np.pad(commands, (0, -len(commands) % 4)).reshape(-1, 4)
+    return (commands[:, 0] | commands[:, 1] << 2 | commands[:, 2] << 4 | commands[:, 3] << 6).tobytes()
+
+
+def _unpack_commands(packed: bytes, count: int) -> np.ndarray:
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    commands = np.stack([packed & 0x3, packed >> 2 & 0x3, packed >> 4 & 0x3, packed >> 6], axis=1)
+    return commands.reshape(-1)[:count].copy()
+
+
+class PlanCache:
+    """
+    On-disk cache of optimal mode plans, in two levels:
+    whole images, keyed by their pixels and the planning options, and single blocks, keyed by their pixels only,
+    so images sharing tiles reuse the routes of those tiles.
+    Each entry is one small binary file; the least recently used ones are removed once the cache outgrows max_size.
+    """
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def plan_key(data: np.ndarray, route_budget: float, reset_interval: Optional[int],
+                 partition: str = DEFAULT_PARTITION) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{CACHE_VERSION}:{route_budget!r}:{reset_interval!r}:{partition}:".encode())
+        digest.update(np.packbits(np.asarray(data, dtype=bool)).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def block_key(image_block: np.ndarray) -> str:
+        image_block = np.asarray(image_block)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{CACHE_VERSION}:{image_block.shape}:".encode())
+        digest.update(np.packbits(image_block != 0).tobytes())
+        # Adaptive blocks give every component its own value, which changes how the block is labeled
+        if image_block.size > 0 and image_block.max() > 1:
+            digest.update(image_block.astype("<u2").tobytes())
+        return digest.hexdigest()
+
+    def _path(self, level: str, key: str) -> str:
+        return os.path.join(self.directory, level, key)
+
+    def _read(self, level: str, key: str) -> Optional[bytes]:
+        path = self._path(level, key)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            os.utime(path)  # The modification time doubles as the last access time
+        except OSError:
+            return None
+        return raw
+
+    def _write(self, level: str, key: str, raw: bytes):
+        directory = os.path.join(self.directory, level)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Written aside then renamed, so concurrent conversions never read half an entry
+            fd, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+            os.replace(temporary_path, self._path(level, key))
+        except OSError:
+            pass  # The cache is only an optimization
+
+    def get_plan(self, key: str) -> Optional[CachedPlan]:
+        raw = self._read("plans", key)
+        if raw is None or len(raw) < PLAN_HEADER.size:
+            return None
+        magic, count, baseline_cost, original_difficulty, current_difficulty = PLAN_HEADER.unpack_from(raw)
+        if magic != PLAN_MAGIC or len(raw) != PLAN_HEADER.size + (count + 3) // 4:
+            return None
+        return CachedPlan(_unpack_commands(raw[PLAN_HEADER.size:], count), baseline_cost,
+                          original_difficulty, current_difficulty)
+
+    def put_plan(self, key: str, plan: CachedPlan):
+        header = PLAN_HEADER.pack(PLAN_MAGIC, len(plan.commands), int(plan.baseline_cost),
+                                  int(plan.original_difficulty), int(plan.current_difficulty))
+        self._write("plans", key, header + _pack_commands(plan.commands))
+
+    def get_block(self, key: str, image_offset: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Route of a cached block, moved to image_offset
+        """
+        raw = self._read("blocks", key)
+        if raw is None or len(raw) < BLOCK_HEADER.size:
+            return None
+        magic, count = BLOCK_HEADER.unpack_from(raw)
+        if magic != BLOCK_MAGIC or len(raw) != BLOCK_HEADER.size + count * 4:
+            return None
+        points = np.frombuffer(raw, dtype="<u2", offset=BLOCK_HEADER.size).reshape(count, 2)
+        return (points.astype(int) + image_offset).astype(POINT_DTYPE)
+
+    def put_block(self, key: str, route: np.ndarray, image_offset: np.ndarray):
+        """
+        Store a block route relative to its block, so the same pixels anywhere in an image share it
+        """
+        points = (np.asarray(route).reshape(-1, 2) - image_offset).astype("<u2")
+        self._write("blocks", key, BLOCK_HEADER.pack(BLOCK_MAGIC, len(points)) + points.tobytes())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for level in ("plans", "blocks"):
+            try:
+                with os.scandir(os.path.join(self.directory, level)) as iterator:
+                    for entry in iterator:
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
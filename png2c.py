@@ -2,16 +2,579 @@
 
 import sys, os, getopt
 import re
-import tqdm
-import math
+import glob
+import collections
+import time
 from PIL import Image
 from generate_route import *
-from typing import Union
+from typing import Optional
+from route_optimizer import DEFAULT_RESET_INTERVAL, DEFAULT_TIME_BUDGET, optimize_block_routes
+from auto_mode import DEFAULT_MAX_RISK, score_print_modes, print_ranking
+from plan_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, CachedPlan, PlanCache
+from repair import score_repairs, print_repairs
+from scanline import line_extents, pack_span_table, unpack_span_table, plan_scanline_visits
+from emulator import emulate, emulate_route, image_bits
+from verify_route import verify_route, print_route_report
+from partition import DEFAULT_PARTITION, PARTITIONS, divide_ink
+from tsp_portfolio import DEFAULT_BLOCK_BUDGET
+from command_codec import ENCODINGS, encode_rle
+import profiler
+from profiler import is_profiling, start_profiling, stop_profiling
+from dither import DEFAULT_DITHER_BUDGET, DITHER_METHODS, dither, score_dithers, print_dither_ranking
+
+import numpy as np
+
+C_HEADER = "#include <stdint.h>\n#include <avr/pgmspace.h>\n\n"
+HEX_TABLE = [hex(i) for i in range(256)]
+# The span table of sparse mode follows the options, the fix lines and the pixels
+SPAN_TABLE_OFFSET = 1 + 40 + 4800
+# Below this many pixels to ink, blocks are planned on threads rather than processes
+SMALL_IMAGE_PIXELS = 2000
+# Seconds batch and server conversions may spend planning the blocks of an image, unless --plandeadline is given
+BATCH_PLAN_DEADLINE = 30.0
+
+
+def image_to_bits(im) -> np.ndarray:
+  """
+  Convert a bilevel image into a 120x320 array holding 1 for black pixels and 0 for white ones,
+  to match the logic in Joystick.c and the invertColormap option
+  """
+  return np.logical_not(np.asarray(im)).astype(np.uint8)
+
+
+def pack_options(option_list, compressed: bool = False) -> int:
+  """
+  Pack the printing options into the first byte, in the bit order CheckImageOptions reads them.
+  Bit 7 flags an optimal command list run-length encoded rather than packed raw.
+  """
+  return (  2**0 * option_list['cautious']
+          + 2**1 * option_list['optimal']
+          + 2**2 * option_list['slowmode']
+          + 2**3 * option_list['endsave']
+          + 2**4 * option_list['vertical']
+          + 2**5 * option_list['fix']
+          + 2**6 * uses_sparse(option_list)
+          + 2**7 * compressed)
+
+
+def uses_sparse(option_list) -> bool:
+  """
+  Sparse scanlines only replace the line sweeps, so optimal and fix mode don't use them
+  """
+  return option_list['sparse'] and not (option_list['optimal'] or option_list['fix'])
+
+
+def pack_fix_rows(all_to_fix) -> np.ndarray:
+  """
+  Pack the 1-based lines/columns to fix into a 320 bit (40 byte) mask, LSB first
+  """
+  fix_data = np.zeros(320, dtype=np.uint8)
+  to_fix = np.asarray(all_to_fix, dtype=np.int64) - 1
+  fix_data[to_fix[(to_fix >= 0) & (to_fix < 320)]] = 1
+  return np.packbits(fix_data, bitorder="little")
+
+
+def pack_image(data: np.ndarray, invert: bool = False) -> np.ndarray:
+  """
+  Pack the 320x120 pixel bits into 4800 bytes, LSB first
+  """
+  packed = np.packbits(data.reshape(-1).astype(np.uint8), bitorder="little")
+  if invert:
+    packed = np.invert(packed)
+  return packed
+
+
+def pack_commands(bin_command_list) -> np.ndarray:
+  """
+  Put 4 two-bit commands into one byte, the first command in the lowest bits.
+  The last byte is padded with zeroes.
+  """
+  commands = np.asarray(bin_command_list, dtype=np.uint8) & 0x3
+  commands = np.pad(commands, (0, -len(commands) % 4)).reshape(-1, 4)
+  return commands[:, 0] | commands[:, 1] << 2 | commands[:, 2] << 4 | commands[:, 3] << 6
+
+
+def length_header(length: int, unit: str = "commands") -> np.ndarray:
+  """
+  Two bytes holding the length of the optimal command list, low byte first (0x17ff => 0xff, 0x17)
+  """
+  if not 0 <= length <= 0xFFFF:
+    raise ValueError(f"The optimal route has {length} {unit}, more than the 65535 the length header can hold!")
+  return np.array([length & 0xFF, length >> 8], dtype=np.uint8)
+
+
+def encode_route(bin_command_list, encoding: str = "auto") -> tuple[bool, list[np.ndarray]]:
+  """
+  Encode the optimal command list with its length header, either raw (the command count, then 4 commands per byte)
+  or run-length encoded (the byte count, then the tokens of command_codec.encode_rle).
+  auto picks whichever is smaller, and raw whenever they tie.
+  Returns whether it's run-length encoded, and the parts.
+  """
+  commands = np.asarray(bin_command_list, dtype=np.uint8)
+  if encoding == "raw":
+    return False, [length_header(len(commands)), pack_commands(commands)]
+  stream = encode_rle(commands)
+  if encoding == "auto" and len(commands) <= 0xFFFF and (len(commands) + 3) // 4 <= len(stream):
+    return False, [length_header(len(commands)), pack_commands(commands)]
+  return True, [length_header(len(stream), "bytes once run-length encoded"), stream]
+
+
+def hex_tokens(values: np.ndarray) -> list[str]:
+  return [HEX_TABLE[value] for value in values.tolist()]
+
+
+def format_c_array(tokens: list[str]) -> str:
+  """
+  Build the .c source, allocating the total byte count for PROGMEM
+  """
+  return (C_HEADER
+          + "const uint8_t image_data[" + hex(len(tokens)) + "] PROGMEM = {"
+          + ", ".join(tokens)
+          + "};\n")
+
+
+def load_image(filename: str):
+  """
+  Open a 320x120 (or 120x320) image, turned to be 320px by 120px
+  """
+  im = Image.open(filename)                # import 320x120 png
 
+  if (im.size[0] == 120 and im.size[1] == 320):
+    print("Rotating image counter-clockwise to make it 320px by 120px!")
+    im = im.transpose(Image.Transpose.ROTATE_90)
 
-def main(argv):
+  if not (im.size[0] == 320 and im.size[1] == 120):
+    raise ValueError("Image must be 320px by 120px!")
+  return im
+
+
+def image_gray(im) -> np.ndarray:
+  return np.asarray(im.convert("L"), dtype=float) / 255
+
+
+def load_bilevel(filename: str, no_dither: bool = False, dither_method: str = "floyd"):
+  """
+  Open a 320x120 (or 120x320) image and convert it into a bilevel image
+  """
+  im = load_image(filename)
+
+  # Convert to bilevel image
+  if no_dither:
+    dither_method = "none"
+  if dither_method == "floyd":
+    return im.convert("1", dither = Image.Dither.FLOYDSTEINBERG)
+  return Image.fromarray(np.logical_not(dither(image_gray(im), dither_method)))
+
+
+def choose_dither(filename: str, option_list, progress: bool = True):
+  """
+  Dither the image with every method, rank them by the inputs needed to print them and how far they look
+  from the original, and return the bilevel image of the best one
+  """
+  def count_inputs(black):
+    im = Image.fromarray(np.logical_not(black))
+    if not option_list['optimal']:
+      # The line sweeps cross every pixel whatever the dither, so only slowmode's extra presses tell them apart
+      return emulate(generate_image_data(image_to_bits(im), option_list, [], None)).reports
+    # Planned through the cache, so the chosen image isn't planned twice
+    bin_command_list, _ = plan_optimal_route(im, False, option_list['route_budget'], option_list['reset_interval'],
+                                             option_list['plan_jobs'], option_list['plan_pool'],
+                                             option_list['partition'], option_list['block_budget'],
+                                             option_list['plan_deadline'], open_plan_cache(option_list))
+    return compute_difficulties(im, bin_command_list)[1]
+
+  ranking = score_dithers(image_gray(load_image(filename)), count_inputs, option_list['dither_budget'])
+  if progress:
+    print_dither_ranking(ranking)
+    print(f"\nAuto dither chose: {ranking[0]['method']}")
+  return Image.fromarray(np.logical_not(ranking[0]['black']))
+
+
+def open_bilevel(filename: str, option_list, progress: bool = True):
+  """
+  Load the image as bilevel with the dither of option_list, choosing it when it's auto
+  """
+  if option_list['dither'] == "auto" and not option_list['no_dither']:
+    return choose_dither(filename, option_list, progress)
+  return load_bilevel(filename, option_list['no_dither'], option_list['dither'])
+
+
+def plan_blocks(divided_image, jobs: Optional[int] = None, pool: str = "auto", progress: bool = True,
+                cache: Optional[PlanCache] = None, block_budget: float = DEFAULT_BLOCK_BUDGET,
+                image_deadline: Optional[float] = None) -> tuple[list[np.ndarray], bool]:
+  """
+  Plan the visit of every block, on a pool of jobs workers (all CPU cores by default).
+  The pool is made of threads or processes; "auto" uses threads for images with little ink,
+  where starting processes would cost more than the planning itself.
+  Every block searches its order for at most block_budget seconds, and none past image_deadline.
+  Blocks found in the cache are not planned again, and the new ones are added to it
+  unless their search ran out of time, so that a later conversion with more time can do better.
+  The routes are returned in block order, so the output is the same as planning the blocks one by one,
+  along with whether every search finished.
+  """
+  import concurrent.futures
+  import itertools
+  import tqdm
+  if jobs is None:
+    jobs = os.cpu_count() or 1
+  images = [item[1] for item in divided_image]
+  offsets = [np.array(item[0]) for item in divided_image]
+  routes = [None] * len(images)
+  if cache is not None:
+    keys = [cache.block_key(image) for image in images]
+    routes = [cache.get_block(key, offset) for key, offset in zip(keys, offsets)]
+  missing = [i for i, route in enumerate(routes) if route is None]
+  missing_images = [images[i] for i in missing]
+  missing_offsets = [offsets[i] for i in missing]
+  if pool == "auto":
+    pool = "thread" if sum(np.count_nonzero(image) for image in missing_images) < SMALL_IMAGE_PIXELS else "process"
+
+  if is_profiling():
+    # Planned one by one, so that the time of each block is its own
+    planned = []
+    for i, image, offset in zip(missing, missing_images, missing_offsets):
+      with profiler.block(i, offset, np.count_nonzero(image)):
+        planned.append(plan_block_visit(image, offset, block_budget, image_deadline))
+  elif jobs <= 1 or len(missing) == 0:
+    planned = list(tqdm.tqdm(map(plan_block_visit, missing_images, missing_offsets, itertools.repeat(block_budget),
+                                 itertools.repeat(image_deadline)),
+                             total=len(missing), desc="Blocks to be visited", disable=not progress))
+  else:
+    if pool == "thread":
+      executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    else:
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    with executor:
+      planned = list(tqdm.tqdm(executor.map(plan_block_visit, missing_images, missing_offsets,
+                                            itertools.repeat(block_budget), itertools.repeat(image_deadline)),
+                               total=len(missing), desc="Blocks to be visited", disable=not progress))
+
+  stored = False
+  for i, (route, complete) in zip(missing, planned):
+    routes[i] = route
+    if cache is not None and complete:
+      cache.put_block(keys[i], route, offsets[i])
+      stored = True
+  # Repairs and sparse images plan blocks without storing a whole plan, so the blocks are evicted here too
+  if stored:
+    cache.evict()
+  return routes, all(complete for _, complete in planned)
+
+
+def plan_optimal_route(im, progress: bool = True, route_budget: float = DEFAULT_TIME_BUDGET,
+                       reset_interval: Optional[int] = DEFAULT_RESET_INTERVAL,
+                       plan_jobs: Optional[int] = None, plan_pool: str = "auto", partition: str = DEFAULT_PARTITION,
+                       block_budget: float = DEFAULT_BLOCK_BUDGET, plan_deadline: Optional[float] = None,
+                       cache: Optional[PlanCache] = None) -> tuple[np.ndarray, int]:
+  """
+  Plan the route for optimal mode and return its 2-bit command list,
+  along with the command count of visiting the blocks in row-major order with a reset after each one.
+  With a cache, a plan made earlier for the same pixels and planning options is reused as it is,
+  and a new plan is only added when no block ran out of search time.
+  """
+  if cache is not None:
+    key = cache.plan_key(image_to_bits(im), route_budget, reset_interval, partition)
+    cached_plan = cache.get_plan(key)
+    if cached_plan is not None:
+      if progress:
+        print("Reusing the cached route for this image!")
+      return cached_plan.commands, cached_plan.baseline_cost
+
+  invert = False
+  if np.sum(np.array(im)) < 38400/2:
+    invert = True
+  if invert == True:
+    ink = np.array(im)
+  else:
+    ink = 1 - np.array(im)
+  bin_command_list, baseline_cost, complete = plan_ink_route(ink, progress, route_budget, reset_interval, plan_jobs,
+                                                             plan_pool, partition, block_budget, plan_deadline, cache)
+
+  if cache is not None and complete:
+    cache.put_plan(key, CachedPlan(bin_command_list, baseline_cost, *compute_difficulties(im, bin_command_list)))
+    cache.evict()
+  return bin_command_list, baseline_cost
+
+
+def plan_ink_route(ink: np.ndarray, progress: bool = True, route_budget: float = DEFAULT_TIME_BUDGET,
+                   reset_interval: Optional[int] = DEFAULT_RESET_INTERVAL,
+                   plan_jobs: Optional[int] = None, plan_pool: str = "auto", partition: str = DEFAULT_PARTITION,
+                   block_budget: float = DEFAULT_BLOCK_BUDGET, plan_deadline: Optional[float] = None,
+                   cache: Optional[PlanCache] = None) -> tuple[np.ndarray, int, bool]:
+  """
+  Plan the command list visiting every pixel set in the 120x320 ink array, its baseline command count,
+  and whether every block finished its search.
+  The ink is planned in blocks, from the adaptive quadtree or the fixed 40x40 grid.
+  Each block searches its order for block_budget seconds at most, and all of them for plan_deadline seconds at most
+  (no limit when None or 0), after which the blocks left keep their first order.
+  """
+  image_deadline = time.monotonic() + plan_deadline if plan_deadline else None
+  with profiler.stage("partition"):
+    divided_image = divide_ink(ink, partition)
+  with profiler.stage("plan_blocks"):
+    block_routes, complete = plan_blocks(divided_image, plan_jobs, plan_pool, progress, cache, block_budget,
+                                         image_deadline)
+  with profiler.stage("route_optimizer"):
+    plan = optimize_block_routes(block_routes, route_budget, reset_interval)
+  with profiler.stage("generate_order"):
+    return generate_order(plan.get_visit_list()), plan.baseline_cost, complete
+
+
+def open_plan_cache(option_list) -> Optional[PlanCache]:
+  if not option_list['cache']:
+    return None
+  return PlanCache(option_list['cache_dir'], option_list['cache_size'])
+
+
+def generate_image_data(data: np.ndarray, option_list, all_to_fix, bin_command_list=None) -> np.ndarray:
+  """
+  Generate the image_data bytes from the pixel bits, the options and the optimal command list
+  """
+  compressed = False
+  route = []
+  if option_list['optimal']:
+    compressed, route = encode_route(bin_command_list, option_list['encoding'])
+  parts = [np.array([pack_options(option_list, compressed)], dtype=np.uint8),  # Adding printing options to the code file
+           pack_fix_rows(all_to_fix),
+           pack_image(data, option_list['invertColormap'])]
+
+  if option_list['optimal']:
+    parts.extend(route)  # The length header, then bin_command_list
+  elif uses_sparse(option_list):
+    ink = np.logical_xor(data, option_list['invertColormap'])
+    parts.append(pack_span_table(*line_extents(ink, option_list['vertical'])))
+
+  parts.append(np.zeros(1, dtype=np.uint8))  # End byte is always 0x0
+  return np.concatenate(parts)
+
+
+def generate_c_source(data: np.ndarray, option_list, all_to_fix, bin_command_list=None) -> str:
+  """
+  Generate the splat_image.c source from the pixel bits, the options and the optimal command list
+  """
+  return format_c_array(hex_tokens(generate_image_data(data, option_list, all_to_fix, bin_command_list)))
+
+
+def summarize_sparse(image_data: np.ndarray, option_list):
+  """
+  Decode the span table back, emulate sweeping only the spans and compare it with sweeping the full lines
+  """
+  line_count = 320 if option_list['vertical'] else 120
+  starts, ends = unpack_span_table(image_data[SPAN_TABLE_OFFSET:], line_count)
+  route = generate_order(VisitList(plan_scanline_visits(starts, ends, option_list['vertical'])))
+  sparse = emulate_route(image_data, route)
+  full = emulate(image_data)
+  wrong_pixels = np.sum(sparse.canvas != image_bits(image_data))
+  print(f"Sparse scanlines: {sparse.reports} USB reports ({int(sparse.seconds // 60)}m {sparse.seconds % 60:.1f}s)"
+        f" instead of {full.reports} ({int(full.seconds // 60)}m {full.seconds % 60:.1f}s) sweeping the full lines")
+  print(f"Pixels differing from the image with sparse scanlines: {wrong_pixels}")
+
+
+def choose_print_mode(data: np.ndarray, option_list, all_to_fix, jobs=None):
+  """
+  Emulate every combination of the cautious, vertical, slowmode, optimal and invertcmap options,
+  print the ranking and switch option_list to the fastest one that prints the image reliably
+  """
+  def encode(data, options):
+    # The firmware doesn't read the optimal command list, so it is left empty while scoring
+    return generate_image_data(data, options, all_to_fix, np.empty(0, dtype=np.uint8))
+
+  ranking = score_print_modes(data, option_list, encode, option_list['max_risk'], jobs)
+  print_ranking(ranking)
+  if not ranking[0]['valid']:
+    print("\nNo option combination prints this image reliably! Keeping the options chosen.")
+    return
+  option_list.update(ranking[0]['options'])
+  print(f"\nAuto mode chose: " + ", ".join(f"{opt}: {value}" for opt, value in ranking[0]['options'].items()))
+
+
+def choose_repair(im, printed_filename: str, option_list) -> Optional[tuple[list[int], Optional[np.ndarray]]]:
+  """
+  Compare the image with what got printed, print the cost of repairing it with fix mode and with a route
+  visiting only the wrong pixels, and switch option_list to the cheapest one.
+  Returns the lines to fix and the route, or None when the print is already right.
+  """
+  printed = image_to_bits(load_bilevel(printed_filename, no_dither=True))
+
+  def encode(data, options, all_to_fix, bin_command_list):
+    return generate_image_data(data, options, all_to_fix, bin_command_list)
+
+  def plan_route(difference):
+    bin_command_list, _, _ = plan_ink_route(difference, True, option_list['route_budget'],
+                                            option_list['reset_interval'], option_list['plan_jobs'],
+                                            option_list['plan_pool'], option_list['partition'],
+                                            option_list['block_budget'], option_list['plan_deadline'],
+                                            open_plan_cache(option_list))
+    return bin_command_list
+
+  ranking = score_repairs(image_to_bits(im), printed, option_list, encode, plan_route)
+  if len(ranking) == 0:
+    return None
+  print_repairs(ranking, option_list['vertical'])
+  best = ranking[0]
+  option_list.update(best['options'])
+  if not best['valid']:
+    print(f"\nNeither repair fixes this print on the firmware! Repairing with {best['method']} anyway.")
+  else:
+    print(f"\nRepairing with {best['method']}!")
+  return best['all_to_fix'], best['bin_command_list']
+
+
+def convert_image(im, option_list, all_to_fix) -> tuple[np.ndarray, dict]:
+  """
+  Plan and encode a bilevel image without printing anything, returning its image_data bytes
+  along with its pixel counts and difficulties
+  """
+  bin_command_list = None
+  if option_list['optimal']:
+    bin_command_list, _ = plan_optimal_route(im, False, option_list['route_budget'], option_list['reset_interval'],
+                                             option_list['plan_jobs'], option_list['plan_pool'],
+                                             option_list['partition'], option_list['block_budget'],
+                                             option_list['plan_deadline'], open_plan_cache(option_list))
+  original_difficulty, current_difficulty = compute_difficulties(im, bin_command_list)
+
+  data = image_to_bits(im)
+  image_data = generate_image_data(data, option_list, all_to_fix, bin_command_list)
+  black = int(np.sum(data))
+  stats = {'black': black,
+           'white': 38400 - black,
+           'original_difficulty': int(original_difficulty),
+           'current_difficulty': int(current_difficulty),
+           'commands': 0 if bin_command_list is None else len(bin_command_list),
+           'bytes': len(image_data)}
+  if option_list['optimal']:
+    report = verify_route(image_data)
+    stats.update(missed_pixels=report.missed, travel_ratio=round(report.travel_ratio, 4))
+  return image_data, stats
+
+
+def convert_file(filename: str, output_path: str, option_list, all_to_fix) -> dict:
+  """
+  Convert one image into its own .c file and return its pixel counts and difficulties
+  """
+  im = open_bilevel(filename, option_list, False)
+  if option_list['saveBilevel']:
+    im.save(os.path.splitext(output_path)[0] + "_bilevel.png")
+
+  image_data, stats = convert_image(im, option_list, all_to_fix)
+  with open(output_path, 'w') as f:
+    f.write(format_c_array(hex_tokens(image_data)))
+  return dict(stats, filename=filename, output=output_path)
+
+
+def collect_batch_files(patterns) -> list[str]:
+  """
+  Expand directories and glob patterns into a sorted list of .png files
+  """
+  filenames = set()
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      filenames.update(glob.glob(os.path.join(pattern, "*.png")))
+    else:
+      filenames.update(glob.glob(pattern))
+  return sorted(filenames)
+
+
+def batch_output_paths(filenames, output_dir: str) -> list[str]:
+  """
+  <output_dir>/<image name>.c for every image. Images of different directories sharing a name are named
+  after their path below the directory they share instead (dir1/a.png => dir1_a.c), then numbered if still taken.
+  """
+  stems = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+  counts = collections.Counter(stem.lower() for stem in stems)
+  shared = [os.path.dirname(os.path.abspath(filename)) for filename, stem in zip(filenames, stems)
+            if counts[stem.lower()] > 1]
+  root = os.path.commonpath(shared) if shared else ""
+  renamed = [counts[stem.lower()] > 1 for stem in stems]
+  output_paths = [""] * len(filenames)
+  taken = set()
+  # Images keeping their own name pick first, so a renamed image never takes it from them
+  for i in sorted(range(len(filenames)), key=lambda i: renamed[i]):
+    stem = stems[i]
+    if renamed[i]:
+      stem = os.path.splitext(os.path.relpath(os.path.abspath(filenames[i]), root))[0].replace(os.sep, "_")
+    name, number = stem, 2
+    # Compared without case, for filesystems that don't tell a.c from A.c
+    while name.lower() in taken:
+      name = f"{stem}_{number}"
+      number += 1
+    taken.add(name.lower())
+    output_paths[i] = os.path.join(output_dir, name + ".c")
+  return output_paths
+
+
+def _convert_batch_item(item) -> dict:
+  filename, output_path, option_list, all_to_fix = item
+  try:
+    return convert_file(filename, output_path, option_list, all_to_fix)
+  except (OSError, ValueError) as e:
+    return {'filename': filename, 'error': str(e)}
+
+
+def batch_convert(patterns, output_dir, option_list, all_to_fix, jobs=None) -> list[dict]:
+  """
+  Convert every image matched by patterns with the same options, spreading the images over a process pool.
+  Each image is saved as <output_dir>/<image name>.c, see batch_output_paths for images sharing a name
+  """
+  import concurrent.futures
+  # Both are chosen by run_conversion for a single image, which a batch never goes through
+  unsupported = [name for name, used in [("--auto", option_list['auto']), ("--repair", option_list['repair'] is not None)]
+                 if used]
+  if unsupported:
+    print(f"ERROR: {', '.join(unsupported)} can't be used with --batch!")
+    return []
+  filenames = collect_batch_files(patterns)
+  if len(filenames) == 0:
+    print("No images found to convert!")
+    return []
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  # Images are already spread over the cores, so each one plans its blocks serially
+  option_list = dict(option_list, plan_jobs=1)
+  if option_list['plan_deadline'] is None:
+    option_list['plan_deadline'] = BATCH_PLAN_DEADLINE
+  items = [(filename, output_path, option_list, all_to_fix)
+           for filename, output_path in zip(filenames, batch_output_paths(filenames, output_dir))]
+  results = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    for result in executor.map(_convert_batch_item, items):
+      results.append(result)
+      if 'error' in result:
+        print(f"{result['filename']}: ERROR: {result['error']}")
+      else:
+        print(f"{result['filename']} -> {result['output']}: "
+              f"Black {result['black']}, White {result['white']}, "
+              f"Original difficulty {result['original_difficulty']}, "
+              f"Current difficulty {result['current_difficulty']}")
+        if result.get('missed_pixels', 0) > 0:
+          print(f"WARNING: The route of {result['filename']} misses {result['missed_pixels']} pixels!")
+  converted = len([result for result in results if 'error' not in result])
+  print(f"\n{converted} of {len(results)} images converted to {output_dir}!")
+  return results
+
+
+def parse_number(arg: str, convert, name: str, default):
+  """
+  The option value converted with convert (int or float), or default when it isn't a number
+  """
+  try:
+    return convert(arg)
+  except ValueError:
+    print(f"{name} must be a number! Using {'the default' if default is None else default}!")
+    return default
+
+
+def parse_arguments(argv) -> tuple[dict, list[int], list[str], str, Optional[int]]:
+  """
+  Parse the command line options into the option list, the lines to fix, the remaining arguments,
+  the batch output directory and the batch job count
+  """
   fix_values = [0, 0]
   fix_value = []
+  all_to_fix = []
+  output_dir = "batch-output"
+  jobs = None
   long_opt_list = ["help",
                    "preview",
                    "savebilevel",
@@ -22,7 +585,30 @@ def main(argv):
                    "slowmode",
                    "endsave",
                    "vertical",
-                   "fix="]
+                   "fix=",
+                   "batch",
+                   "outdir=",
+                   "jobs=",
+                   "routebudget=",
+                   "resetinterval=",
+                   "planjobs=",
+                   "planpool=",
+                   "partition=",
+                   "blockbudget=",
+                   "plandeadline=",
+                   "encoding=",
+                   "auto",
+                   "maxrisk=",
+                   "nocache",
+                   "cachedir=",
+                   "cachesize=",
+                   "repair=",
+                   "dither=",
+                   "ditherbudget=",
+                   "sparse",
+                   "profile=",
+                   "profilememory",
+                   "cprofile="]
   opts, args = getopt.getopt(argv, "hpbcoseinvf:", long_opt_list)
   option_list = {'previewBilevel': False, 
                  'saveBilevel': False,
@@ -33,7 +619,28 @@ def main(argv):
                  'slowmode': False,
                  'endsave': False,
                  'vertical': False,
-                 'fix': False}
+                 'fix': False,
+                 'batch': False,
+                 'route_budget': DEFAULT_TIME_BUDGET,
+                 'reset_interval': DEFAULT_RESET_INTERVAL,
+                 'plan_jobs': None,
+                 'plan_pool': "auto",
+                 'partition': DEFAULT_PARTITION,
+                 'block_budget': DEFAULT_BLOCK_BUDGET,
+                 'plan_deadline': None,
+                 'encoding': "auto",
+                 'auto': False,
+                 'max_risk': DEFAULT_MAX_RISK,
+                 'cache': True,
+                 'cache_dir': DEFAULT_CACHE_DIR,
+                 'cache_size': DEFAULT_CACHE_SIZE,
+                 'repair': None,
+                 'dither': "floyd",
+                 'dither_budget': DEFAULT_DITHER_BUDGET,
+                 'sparse': False,
+                 'profile': None,
+                 'profile_memory': False,
+                 'cprofile': None}
   #print(opts, args)
   for opt, arg in opts:
     if opt in ['-h', '--help']:
@@ -57,6 +664,65 @@ def main(argv):
       option_list['invertColormap'] = True
     elif opt in ['-v', '--vertical']:
       option_list['vertical'] = True
+    elif opt == '--batch':
+      option_list['batch'] = True
+    elif opt == '--outdir':
+      output_dir = arg
+    elif opt == '--jobs':
+      jobs = parse_number(arg, int, "The job count", None)
+    elif opt == '--routebudget':
+      option_list['route_budget'] = parse_number(arg, float, "The route budget", DEFAULT_TIME_BUDGET)
+    elif opt == '--resetinterval':
+      reset_interval = parse_number(arg, int, "The reset interval", DEFAULT_RESET_INTERVAL)
+      option_list['reset_interval'] = reset_interval if reset_interval > 0 else None
+    elif opt == '--auto':
+      option_list['auto'] = True
+    elif opt == '--maxrisk':
+      option_list['max_risk'] = parse_number(arg, float, "The maximum risk", DEFAULT_MAX_RISK)
+    elif opt == '--dither':
+      if arg not in DITHER_METHODS + ["auto"]:
+        print(f"The dither must be one of {', '.join(DITHER_METHODS)} or auto! Using floyd!")
+        arg = "floyd"
+      option_list['dither'] = arg
+    elif opt == '--ditherbudget':
+      option_list['dither_budget'] = parse_number(arg, float, "The dither budget", DEFAULT_DITHER_BUDGET)
+    elif opt == '--profile':
+      option_list['profile'] = arg
+    elif opt == '--profilememory':
+      option_list['profile_memory'] = True
+    elif opt == '--cprofile':
+      option_list['cprofile'] = arg
+    elif opt == '--sparse':
+      option_list['sparse'] = True
+    elif opt == '--repair':
+      option_list['repair'] = arg
+    elif opt == '--nocache':
+      option_list['cache'] = False
+    elif opt == '--cachedir':
+      option_list['cache_dir'] = arg
+    elif opt == '--cachesize':
+      option_list['cache_size'] = int(parse_number(arg, float, "The cache size", DEFAULT_CACHE_SIZE / 1024 / 1024) * 1024 * 1024)
+    elif opt == '--planjobs':
+      option_list['plan_jobs'] = parse_number(arg, int, "The plan job count", None)
+    elif opt == '--planpool':
+      if arg not in ["auto", "thread", "process"]:
+        print("The plan pool must be auto, thread or process! Using auto!")
+        arg = "auto"
+      option_list['plan_pool'] = arg
+    elif opt == '--partition':
+      if arg not in PARTITIONS:
+        print("The partition must be adaptive or grid! Using grid!")
+        arg = DEFAULT_PARTITION
+      option_list['partition'] = arg
+    elif opt == '--blockbudget':
+      option_list['block_budget'] = parse_number(arg, float, "The block budget", DEFAULT_BLOCK_BUDGET)
+    elif opt == '--plandeadline':
+      option_list['plan_deadline'] = parse_number(arg, float, "The plan deadline", None)
+    elif opt == '--encoding':
+      if arg not in ENCODINGS:
+        print("The encoding must be auto, raw or rle! Using auto!")
+        arg = "auto"
+      option_list['encoding'] = arg
     elif opt in ['-f', '--fix']:
       all_to_fix = []
       arglist = arg.split(',')
@@ -93,8 +759,32 @@ def main(argv):
           
             all_to_fix.extend(list(range(fix_values[0] + 1, fix_values[1] + 1)))
       all_to_fix = list(sorted(set(all_to_fix)))
+  return option_list, all_to_fix, args, output_dir, jobs
+
+
+def main(argv):
+  option_list, all_to_fix, args, output_dir, jobs = parse_arguments(argv)
+  if option_list['profile'] is None and option_list['cprofile'] is None:
+    run_conversion(option_list, all_to_fix, args, output_dir, jobs)
+    return
+
+  start_profiling(option_list['profile_memory'], option_list['cprofile'])
+  try:
+    with profiler.stage("total"):
+      run_conversion(option_list, all_to_fix, args, output_dir, jobs)
+  finally:
+    report = stop_profiling()
+    print("\n-= Profile =-")
+    report.print_table()
+    if option_list['profile'] is not None:
+      report.save(option_list['profile'])
+      print(f"Profile saved to {option_list['profile']}!")
+
+def run_conversion(option_list, all_to_fix, args, output_dir, jobs):
+  if option_list['batch']:
+    batch_convert(args, output_dir, option_list, all_to_fix, jobs)
+    return
 
-  all_to_fix = []
   filename = args[0]
   filename_direct = os.path.basename(filename)
   if not os.path.isdir("splat-images"):
@@ -104,22 +794,13 @@ def main(argv):
 
   if not os.path.isfile(filename):
     filename = "splat-images\\" + filename
-  im = Image.open(filename)                # import 320x120 png
-
-  if (im.size[0] == 120 and im.size[1] == 320):
-    print("Rotating image counter-clockwise to make it 320px by 120px!")
-    im = im.transpose(Image.Transpose.ROTATE_90)
-  
-  if not (im.size[0] == 320 and im.size[1] == 120):
-    print("ERROR: Image must be 320px by 120px!")
+  try:
+    with profiler.stage("load"):
+      im = open_bilevel(filename, option_list)
+  except ValueError as e:
+    print(f"ERROR: {e}")
     sys.exit()
 
-  # Convert to bilevel image
-  if option_list['no_dither']:
-    im = im.convert("1", dither = None) # this also adds dithering if wanted
-  else:
-    im = im.convert("1", dither = Image.Dither.FLOYDSTEINBERG)
-
   if option_list['previewBilevel']:
     print(f"Previewing {filename_direct}!")
     im.show()
@@ -128,107 +809,59 @@ def main(argv):
     im.save(f"preview-images\\bilevel_{filename_direct}")
     print("Bilevel preview version of " + filename_direct + " saved as bilevel_" + filename_direct)
 
-  if option_list['optimal']:
-    invert = False
-    if np.sum(np.array(im)) < 38400/2:
-      invert = True
-    if invert == True:
-      divided_image = divide_image(np.array(im))
-    else:
-      divided_image = divide_image(1 - np.array(im))
-    visit_list: list[Union[ResetPosition, np.ndarray]] = []
-    for item in tqdm.tqdm(divided_image, desc="Blocks to be visited"):
-        visit_list += generate_block_visit(item[1], np.array(item[0]))
-        if len(visit_list) == 0 or isinstance(visit_list[-1], ResetPosition):
-            continue
-        visit_list.append(find_nearest_reset_position(visit_list[-1]))
-    bin_command_list = generate_order(visit_list)
-    summarize_difficulties(im, bin_command_list) #check if suboptimal, then remove optimal if so
+  if option_list['auto']:
+    with profiler.stage("auto"):
+      choose_print_mode(image_to_bits(im), option_list, all_to_fix, jobs)
+
+  bin_command_list = None
+  if option_list['repair'] is not None:
+    try:
+      with profiler.stage("repair"):
+        repair = choose_repair(im, option_list['repair'], option_list)
+    except (OSError, ValueError) as e:
+      print(f"ERROR: {e}")
+      sys.exit()
+    if repair is None:
+      print(f"{option_list['repair']} already matches {filename}, there's nothing to repair!")
+      sys.exit()
+    all_to_fix, bin_command_list = repair
+  elif option_list['optimal']:
+    with profiler.stage("plan"):
+      bin_command_list, baseline_length = plan_optimal_route(im, True, option_list['route_budget'],
+                                                             option_list['reset_interval'], option_list['plan_jobs'],
+                                                             option_list['plan_pool'], option_list['partition'],
+                                                             option_list['block_budget'], option_list['plan_deadline'],
+                                                             open_plan_cache(option_list))
+    summarize_difficulties(im, bin_command_list, baseline_length) #check if suboptimal, then remove optimal if so
 
   if not (option_list['previewBilevel'] or option_list['saveBilevel']):
-    im_px = im.load()
-    data = []
-    for i in range(0, 120):                # iterate over the columns
-      for j in range(0, 320):              # and convert 255 vals to 0 to match logic in Joystick.c and invertColormap option
-         data.append(0 if im_px[j, i] == 255 else 1)
-
-    bytecount = 1 #Starts at 1 since the last byte is always 0x0.
-    str_out = "#include <stdint.h>\n#include <avr/pgmspace.h>\n\nconst uint8_t image_data[] PROGMEM = {"
-    
-    options = hex(  2**0 * option_list['cautious'] # Adding printing options to the code file
-                  + 2**1 * option_list['optimal'] 
-                  + 2**2 * option_list['slowmode'] 
-                  + 2**3 * option_list['endsave'] 
-                  + 2**4 * option_list['vertical']
-                  + 2**5 * option_list['fix'])
-
-    str_out += options + ", "
-    bytecount += 1
-
-    fix_data = []
-    for i in range(1, 321):
-      if i in all_to_fix:
-        fix_data.append(1)
-      else:
-        fix_data.append(0)
-
-    for i in range(40):
-      bytecount += 1
-      val = 0
-      for j in range(0, 8):
-          val |= fix_data[(i * 8) + j] << j
-      str_out += hex(val) + ", "
-
-    for i in range(0, 4800): # 320 x 120 / 8
-      bytecount += 1
-      val = 0
-
-      for j in range(0, 8):
-        val |= data[(i * 8) + j] << j
-
-      if (option_list['invertColormap']):
-        val = ~val & 0xFF
-      else:
-        val = val & 0xFF
-
-      str_out += hex(val) + ", "          # append hexidecimal bytes
-                                          # to the output .c array of bytes
-
-    if option_list['optimal']:
-      bytecount += 2 #To define the length of bin_command_list
-      if len(bin_command_list) > 256:
-        optimal_size_part1 = hex(len(bin_command_list))[:4]
-        optimal_size_part2 = "0x" + hex(len(bin_command_list))[4:] #Divide hex into 2 parts; You attach them directly, so for example, 0x17 0xff => 0x17ff
-        str_out += optimal_size_part1 + ", " + optimal_size_part2 + ", "
-      else:
-        str_out += hex(len(bin_command_list)) + ", " + hex(0) + ", "
-
-      for i in range(0, len(bin_command_list), 4): #Put 4 commands into one hex value.
-        bytecount += 1
-        if i + 3 <= len(bin_command_list):
-          str_out += hex(bin_command_list[i] + bin_command_list[i + 1]*2**2 + bin_command_list[i + 2]*2**4 + bin_command_list[i + 3]*2**6)
-        else:
-          final_command_sum = bin_command_list[i]
-          if i + 1 < len(bin_command_list):
-            final_command_sum += bin_command_list[i + 1]*2**2
-          if i + 2 < len(bin_command_list):
-            final_command_sum += bin_command_list[i + 2]*2**4
-          str_out += hex(final_command_sum)
-        str_out += ", "
-
-    str_out += "0x0};\n"                  # End byte is always 0x0
-
-    str_out = str_out[:72] + hex(bytecount) + str_out[72:] #Inserting the total byte count to allocate for PROGMEM
-
-    with open('splat_image.c', 'w') as f:       # save output into image.c
+    data = image_to_bits(im)
+    try:
+      with profiler.stage("encode"):
+        image_data = generate_image_data(data, option_list, all_to_fix, bin_command_list)
+    except ValueError as e:
+      print(f"ERROR: {e}")
+      sys.exit()
+    if option_list['optimal'] and option_list['repair'] is None:
+      with profiler.stage("verify"):
+        route_report = verify_route(image_data)
+      print_route_report(route_report)
+    with profiler.stage("format"):
+      str_out = format_c_array(hex_tokens(image_data))
+
+    with profiler.stage("write"), open('splat_image.c', 'w') as f:       # save output into image.c
       f.write(str_out)
 
     if (option_list['invertColormap']):
        print("{} converted with inverted colormap and saved to splat_image.c!".format(filename))
     else:
        print("{} converted with original colormap and saved to splat_image.c!".format(filename))
-    print(f"Black Pixel Count: {sum(data)}")
-    print(f"White Pixel Count: {38400 - sum(data)}")
+    print(f"Black Pixel Count: {np.sum(data)}")
+    print(f"White Pixel Count: {38400 - np.sum(data)}")
+    if uses_sparse(option_list):
+      summarize_sparse(image_data, option_list)
+    elif option_list['sparse']:
+      print("Sparse scanlines only apply to the line by line modes, so they weren't used!")
     print(f"\n-= Options chosen =-")
     for opt in option_list:
         print(f"{opt}: {option_list[opt]}")
@@ -251,6 +884,13 @@ def usage():
   print("--invertcmap [-i]: Convert to an inverted splat_image.c")
   print("--preview [-p]: Preview bilevel splat_image.c")
   print("--savebilevel [-b]: Save bilevel splat_image.c")
+  print("--nodither [-n]: Convert without dithering, each pixel turning black or white on its own")
+  print("--dither <floyd|bayer|atkinson|bluenoise|clustered|none|auto>: How to dither the image (default: floyd)")
+  print("  * Ordered dithers (bayer, bluenoise and above all clustered) make fewer isolated pixels than floyd,")
+  print("    which shortens the route and the planning of optimal mode.")
+  print("  * auto tries them all and keeps the best tradeoff between the inputs needed and how close the image looks.")
+  print("    Without -o the inputs only differ with slowmode, since the line sweeps cross every pixel.")
+  print("--ditherbudget <seconds>: Time auto dither may spend trying methods (default: 20)")
   print("\n-=CONFIGS=-")
   print("--cautious [-c]: To print in cautious mode")
   print("  * Cautious mode adds extra, 3 blank inputs to each line print, that way, any dropped inputs in a line")
@@ -282,6 +922,54 @@ def usage():
   print("  * If the values are improper (less than 1, greater than 120 for horizontal printing and 320 for vertical printing,")
   print("    or the left value is bigger than the right value), it will try to fix the values automatically. Otherwise,")
   print("    it will ignore fix mode (e.g. negative values, letters, improper syntax).")
+  print("")
+  print("--sparse: Add a table of the inked span of every line, so the lines are only swept where there's ink")
+  print("  * Blank lines are skipped and each span is swept from its nearest end. Not used with optimal or fix mode.")
+  print("")
+  print("--repair <printed.png>: Repair a print, given the image and a 320x120 capture or bilevel export of what got printed")
+  print("  * The wrong pixels are found automatically, and the repair is done with fix mode on the lines holding them,")
+  print("    or with a route visiting only the wrong pixels, whichever needs fewer inputs. Replaces the --fix values.")
+  print("    Both are checked on the emulated firmware, which runs its fix pass instead of following the route.")
+  print("")
+  print("--routebudget <seconds>: Time spent improving the order of the blocks in optimal mode (default: 1)")
+  print("  * The blocks are visited in the order, direction and with the resets that need the fewest inputs.")
+  print("--resetinterval <N>: Most inputs printed in optimal mode before the cursor is reset to a corner (default: 3000)")
+  print("  * Resetting keeps dropped inputs from shifting the rest of the image. 0 only resets when it's shorter than travelling.")
+  print("--planjobs <N>: How many blocks to plan at the same time in optimal mode (default: number of CPU cores)")
+  print("--planpool <auto|thread|process>: Plan the blocks on threads or processes (default: auto, threads for small images)")
+  print("--blockbudget <seconds>: Most time spent ordering the components of each block in optimal mode (default: 2)")
+  print("  * Small blocks are solved exactly and the others improved until no move helps or their time runs out.")
+  print("--plandeadline <seconds>: Most time spent ordering the components of all the blocks of an image, 0 for none")
+  print("  * Blocks left when it runs out keep their first order. Defaults to none, and to 30 for --batch.")
+  print("--partition <adaptive|grid>: How the image is divided into blocks planned separately in optimal mode (default: grid)")
+  print("  * adaptive splits the image where the ink is dense and keeps it whole where it's sparse, so no block has")
+  print("    more than 128 components to order, and components crossing block borders aren't split. grid uses fixed 40x40 blocks.")
+  print("    adaptive routes are about 1% shorter, but take longer to plan on noisy images.")
+  print("--encoding <auto|raw|rle>: How the optimal mode commands are stored (default: auto, whichever is smaller)")
+  print("  * rle stores corner resets and long straight moves as runs, so longer routes fit in the same flash.")
+  print("    It's flagged in bit 7 of the options byte.")
+  print("--nocache: Plan the route from scratch, without reading or updating the plan cache")
+  print("  * Optimal mode routes are cached per image and per block, so converting the same image again")
+  print("    with other printing options (e.g. --endsave) reuses the route instead of planning it again.")
+  print("--cachedir <directory>: Where the plan cache is kept (default: ~/.cache/splat-printer)")
+  print("--cachesize <MiB>: Size above which the least recently used plans are removed (default: 64)")
+  print("")
+  print("--auto: Choose the cautious, vertical, slowmode, optimal and invertcmap options automatically")
+  print("  * Every combination is emulated, and the fastest one printing the image correctly is used. A ranked table is shown.")
+  print("--maxrisk <F>: Above this fraction of colour changes along a line, auto mode requires slowmode (default: 0.05)")
+  print("")
+  print("--batch <directory or glob> ...: To convert many images at once with the same options")
+  print("  * Every image is converted into its own .c file, named after the image, in parallel on all CPU cores.")
+  print("    Images of different directories sharing a name are named after their directories too (dir1_a.c, dir2_a.c).")
+  print("  * --outdir <directory>: Where to save the .c files (default: batch-output).")
+  print("  * --jobs <N>: How many images to convert at the same time (default: number of CPU cores).")
+  print("  * --auto and --repair only work on a single image.")
+  print("")
+  print("--profile <report.json>: Time every stage of the conversion and every block planned, and save it as JSON")
+  print("  * A table of the stages and of the slowest blocks, with their components and TSP sizes, is shown too.")
+  print("  * Blocks are planned one at a time while profiling, so their times don't overlap.")
+  print("--profilememory: Also record the peak memory of every stage and block, and the largest allocations (slower)")
+  print("--cprofile <file.prof>: Also run cProfile and save its statistics, e.g. for snakeviz")
 
 if __name__ == "__main__":
   if len(sys.argv[1:]) == 0:
@@ -0,0 +1,173 @@
+import contextlib
+import json
+import time
+import tracemalloc
+from typing import Optional
+
+# Allocation sites kept from the tracemalloc snapshot
+TRACEMALLOC_TOP = 15
+# Functions shown from the cProfile statistics
+CPROFILE_TOP = 15
+
+_active = None
+
+
+class Profiler:
+    """
+    Wall time, CPU time and, with memory, peak traced memory of nested stages and of every planned block.
+    Blocks also hold their component count, TSP size and the time of their own steps.
+    """
+    def __init__(self, memory: bool = False, cprofile: Optional[str] = None):
+        self.memory = memory
+        self.cprofile = cprofile
+        self.stages = []
+        self.blocks = []
+        self.frames = []
+        self.current_block = None
+        self.cprofiler = None
+        self.tracemalloc_top = []
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+        if self.cprofile is not None:
+            import cProfile
+            self.cprofiler = cProfile.Profile()
+            self.cprofiler.enable()
+
+    def stop(self):
+        if self.cprofiler is not None:
+            self.cprofiler.disable()
+            self.cprofiler.dump_stats(self.cprofile)
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            self.tracemalloc_top = [{'site': str(statistic.traceback), 'bytes': statistic.size, 'count': statistic.count}
+                                    for statistic in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]]
+            tracemalloc.stop()
+
+    def _enter(self, record: dict):
+        if self.memory:
+            if self.frames:
+                self.frames[-1]['peak_bytes'] = max(self.frames[-1]['peak_bytes'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            record['peak_bytes'] = 0
+        record['wall'] = -time.perf_counter()
+        record['cpu'] = -time.process_time()
+        self.frames.append(record)
+
+    def _exit(self, record: dict):
+        record['wall'] += time.perf_counter()
+        record['cpu'] += time.process_time()
+        self.frames.pop()
+        if self.memory:
+            record['peak_bytes'] = max(record['peak_bytes'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            if self.frames:
+                self.frames[-1]['peak_bytes'] = max(self.frames[-1]['peak_bytes'], record['peak_bytes'])
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        record = {'stage': name, 'depth': len([frame for frame in self.frames if 'stage' in frame])}
+        self.stages.append(record)
+        self._enter(record)
+        try:
+            yield record
+        finally:
+            self._exit(record)
+
+    @contextlib.contextmanager
+    def block(self, index: int, offset, pixels: int):
+        record = {'block': index, 'offset': [int(value) for value in offset], 'pixels': int(pixels)}
+        self.blocks.append(record)
+        self.current_block = record
+        self._enter(record)
+        try:
+            yield record
+        finally:
+            self._exit(record)
+            self.current_block = None
+
+    @contextlib.contextmanager
+    def block_step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current_block is not None:
+                key = f"{name}_seconds"
+                self.current_block[key] = self.current_block.get(key, 0.0) + time.perf_counter() - start
+
+    def note_block(self, **values):
+        if self.current_block is not None:
+            self.current_block.update(values)
+
+    def report(self) -> dict:
+        return {'stages': self.stages, 'blocks': self.blocks, 'tracemalloc_top': self.tracemalloc_top}
+
+    def save(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_table(self, block_count: int = 10):
+        memory_header = f" {'peak':>10}" if self.memory else ""
+        print(f"{'stage':<28} {'wall (s)':>9} {'cpu (s)':>9}{memory_header}")
+        for record in self.stages:
+            memory = f" {record['peak_bytes'] / 1024:>8.0f}KB" if self.memory else ""
+            print(f"{'  ' * record['depth'] + record['stage']:<28} {record['wall']:>9.4f} {record['cpu']:>9.4f}{memory}")
+        if self.blocks:
+            print(f"\nSlowest blocks of {len(self.blocks)}:")
+            print(f"{'block':>5} {'offset':>10} {'pixels':>6} {'comps':>5} {'tsp':>5} {'solver':>7}"
+                  f" {'label (s)':>9} {'tsp (s)':>8} {'wall (s)':>8}")
+            for record in sorted(self.blocks, key=lambda record: record['wall'], reverse=True)[:block_count]:
+                offset = f"{record['offset'][0]},{record['offset'][1]}"
+                print(f"{record['block']:>5} {offset:>10} {record['pixels']:>6} {record.get('components', 0):>5}"
+                      f" {record.get('tsp_nodes', 0):>5} {record.get('solver', '-'):>7}"
+                      f" {record.get('label_seconds', 0.0):>9.4f} {record.get('tsp_seconds', 0.0):>8.4f}"
+                      f" {record['wall']:>8.4f}")
+        if self.cprofile is not None:
+            import pstats
+            print(f"\ncProfile statistics saved to {self.cprofile}, most cumulative time:")
+            pstats.Stats(self.cprofile).sort_stats("cumulative").print_stats(CPROFILE_TOP)
+        if self.tracemalloc_top:
+            print("Largest allocations still alive:")
+            for allocation in self.tracemalloc_top[:5]:
+                print(f"  {allocation['bytes'] / 1024:>8.0f}KB {allocation['site']}")
+
+
+def start_profiling(memory: bool = False, cprofile: Optional[str] = None) -> Profiler:
+    global _active
+    _active = Profiler(memory, cprofile)
+    _active.start()
+    return _active
+
+
+def stop_profiling() -> Optional[Profiler]:
+    global _active
+    profiler, _active = _active, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def is_profiling() -> bool:
+    return _active is not None
+
+
+def stage(name: str):
+    """
+    Context manager profiling a stage of the conversion, doing nothing when no profiling is running
+    """
+    return _active.stage(name) if _active is not None else contextlib.nullcontext()
+
+
+def block(index: int, offset, pixels: int):
+    return _active.block(index, offset, pixels) if _active is not None else contextlib.nullcontext()
+
+
+def block_step(name: str):
+    return _active.block_step(name) if _active is not None else contextlib.nullcontext()
+
+
+def note_block(**values):
+    if _active is not None:
+        _active.note_block(**values)
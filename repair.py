@@ -0,0 +1,88 @@
+import numpy as np
+
+from emulator import REPORT_PERIOD, ECHOES, emulate, emulate_route, image_bits
+
+
+def printed_difference(target: np.ndarray, printed: np.ndarray) -> np.ndarray:
+    """
+    Boolean 120x320 mask of the pixels where the printed canvas differs from the target canvas
+    """
+    return np.asarray(target, dtype=bool) != np.asarray(printed, dtype=bool)
+
+
+def repair_lines(difference: np.ndarray, vertical: bool = False) -> list[int]:
+    """
+    The 1-based lines (or columns when vertical) holding at least one wrong pixel, as fix mode numbers them
+    """
+    return (np.flatnonzero(difference.any(axis=0 if vertical else 1)) + 1).tolist()
+
+
+def score_repairs(data: np.ndarray, printed: np.ndarray, option_list, encode, plan_route,
+                  report_period: float = REPORT_PERIOD) -> list[dict]:
+    """
+    Cost both ways of repairing a print, cheapest first:
+    fix mode on the lines holding wrong pixels, emulated on the printed canvas,
+    and a route visiting only the wrong pixels, each of them inked or erased after the image.
+    Both are timed with what the firmware runs on their image_data, so a route it doesn't follow is timed
+    and checked as the fix pass it runs instead.
+    encode(data, options, all_to_fix, bin_command_list) must return the image_data bytes of a repair
+    and plan_route(difference) the command list visiting every pixel of the difference mask.
+    Returns an empty list when nothing needs repairing.
+    """
+    target = image_bits(encode(data, dict(option_list, fix=False, optimal=False), [], None))
+    difference = printed_difference(target, printed)
+    if not difference.any():
+        return []
+    wrong_pixels = int(np.count_nonzero(difference))
+    lines = repair_lines(difference, option_list['vertical'])
+
+    fix_options = dict(option_list, fix=True, optimal=False)
+    result = emulate(encode(data, fix_options, lines, None), report_period, initial_canvas=printed)
+    fix_valid = result.finished and np.array_equal(result.canvas, target)
+    fix_repair = {'method': "fix",
+                  'options': fix_options,
+                  'all_to_fix': lines,
+                  'bin_command_list': None,
+                  'reports': result.logical_reports,
+                  'valid': fix_valid,
+                  'status': "ok" if fix_valid else "does not repair the print"}
+
+    # Fix mode inks or erases every pixel the cursor stops on after the image, so the route needs the fix bit too.
+    # The fix lines stay in the mask, for firmware reading the options without the route.
+    route_options = dict(option_list, fix=True, optimal=True)
+    bin_command_list = plan_route(difference.astype(np.uint8))
+    route_data = encode(data, route_options, lines, bin_command_list)
+    routed = emulate_route(route_data, bin_command_list, report_period, initial_canvas=printed)
+    # Joystick.c doesn't read the route, it runs its own fix pass on the lines of the mask
+    result = emulate(route_data, report_period, initial_canvas=printed)
+    route_valid = result.finished and np.array_equal(result.canvas, target)
+    if not np.array_equal(routed.canvas, target):
+        status = "the route misses wrong pixels"
+    elif not route_valid:
+        status = (f"the firmware can't follow the route ({routed.logical_reports} reports),"
+                  " and its fix pass does not repair the print")
+    else:
+        status = f"ok, but the firmware runs its fix pass instead of the route ({routed.logical_reports} reports)"
+    route_repair = {'method': "route",
+                    'options': route_options,
+                    'all_to_fix': lines,
+                    'bin_command_list': bin_command_list,
+                    'reports': result.logical_reports,
+                    'valid': route_valid and np.array_equal(routed.canvas, target),
+                    'status': status}
+
+    ranking = [fix_repair, route_repair]
+    for repair in ranking:
+        repair['wrong_pixels'] = wrong_pixels
+        repair['seconds'] = repair['reports'] * (1 + ECHOES) * report_period
+    ranking.sort(key=lambda repair: (not repair['valid'], repair['reports']))
+    return ranking
+
+
+def print_repairs(ranking: list[dict], vertical: bool = False):
+    line_name = "columns" if vertical else "lines"
+    print(f"{ranking[0]['wrong_pixels']} wrong pixels on {len(ranking[0]['all_to_fix'])} {line_name}")
+    print(f"{'#':>3} {'method':>6} {'reports':>8} {'time':>9}  status")
+    for rank, repair in enumerate(ranking, 1):
+        minutes, seconds = divmod(repair['seconds'], 60)
+        print(f"{rank:>3} {repair['method']:>6} {repair['reports']:>8} {int(minutes):>3}m {seconds:4.1f}s  {repair['status']}")
@@ -0,0 +1,165 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from generate_route import RESET_SEGMENTS, VisitList, find_nearest_reset_positions
+
+# Every reset moves half the canvas width and half its height
+RESET_COST = int(sum(RESET_SEGMENTS["lu"][1]))
+# Maximum number of commands printed without a reset, so dropped inputs don't drift too far
+DEFAULT_RESET_INTERVAL = 3000
+# Seconds of local search spent improving the block order
+DEFAULT_TIME_BUDGET = 1.0
+
+
+class BlockRoutePlan:
+    """
+    Order, direction and resets chosen for the block routes.
+    Every block route is a (k, 2) array of points, visited forward or reversed.
+    """
+    def __init__(self, block_routes: list[np.ndarray], order: list[int], reversed_blocks: list[bool],
+                 resets: list[bool], cost: int, baseline_cost: int):
+        self.block_routes = block_routes
+        self.order = order
+        self.reversed_blocks = reversed_blocks
+        self.resets = resets
+        self.cost = cost
+        self.baseline_cost = baseline_cost
+
+    def get_visit_list(self) -> VisitList:
+        routes = [self.block_routes[block][::-1] if is_reversed else self.block_routes[block]
+                  for block, is_reversed in zip(self.order, self.reversed_blocks)]
+        return VisitList.from_routes(routes, self.resets)
+
+
+class BlockRouteOptimizer:
+    """
+    Route the blocks as a higher level TSP: each block is a node that can be entered at either end of its route.
+    Between two blocks the cursor either travels directly or resets to the corner nearest the exit point,
+    whichever is cheaper, unless a reset is needed to stay under reset_interval commands.
+    """
+    def __init__(self, block_routes: list[np.ndarray], reset_interval: Optional[int] = DEFAULT_RESET_INTERVAL):
+        self.block_routes = block_routes
+        self.reset_interval = reset_interval
+        self.internal_cost = [int(np.abs(np.diff(route, axis=0)).sum()) for route in block_routes]
+
+        # State 2 * block is the block visited forward, 2 * block + 1 reversed
+        ends = np.array([(route[0], route[-1]) for route in block_routes]).reshape(-1, 2, 2)
+        entries = np.stack([ends[:, 0], ends[:, 1]], axis=1).reshape(-1, 2)
+        exits = np.stack([ends[:, 1], ends[:, 0]], axis=1).reshape(-1, 2)
+        corner = np.array([reset.get_position() for reset in find_nearest_reset_positions(exits)])
+        # Kept as lists, since evaluate reads them one element at a time
+        self.start_cost = np.abs(entries).sum(axis=1).tolist()
+        self.travel_cost = np.abs(exits[:, np.newaxis, :] - entries[np.newaxis, :, :]).sum(axis=2).tolist()
+        self.reset_cost = (RESET_COST + np.abs(corner[:, np.newaxis, :] - entries[np.newaxis, :, :]).sum(axis=2)).tolist()
+
+    def evaluate(self, order: list[int], reversed_blocks: list[bool]) -> tuple[int, list[bool]]:
+        """
+        Total command count of visiting the blocks in this order and direction, and where to reset
+        """
+        total = 0
+        resets = []
+        since_reset = 0
+        previous = None
+        for block, is_reversed in zip(order, reversed_blocks):
+            state = 2 * block + is_reversed
+            internal = self.internal_cost[block]
+            if previous is None:
+                travel, reset = self.start_cost[state], False
+            else:
+                travel = self.travel_cost[previous][state]
+                reset_travel = self.reset_cost[previous][state]
+                reset = (reset_travel < travel
+                         or (self.reset_interval is not None
+                             and since_reset + travel + internal > self.reset_interval))
+                if reset:
+                    travel = reset_travel
+                    since_reset = travel - RESET_COST
+            if not reset:
+                since_reset += travel
+            since_reset += internal
+            total += travel + internal
+            resets.append(reset)
+            previous = state
+        return int(total), resets
+
+    def baseline_cost(self) -> int:
+        """
+        Command count of the row-major order with a reset after every block
+        """
+        total = 0
+        previous = None
+        for block in range(len(self.block_routes)):
+            state = 2 * block
+            total += self.start_cost[state] if previous is None else self.reset_cost[previous][state]
+            total += self.internal_cost[block]
+            previous = state
+        return int(total + RESET_COST * (previous is not None))
+
+    def nearest_neighbour(self) -> tuple[list[int], list[bool]]:
+        transition = np.minimum(self.travel_cost, self.reset_cost)
+        remaining = np.ones(len(self.block_routes), dtype=bool)
+        state = int(np.argmin(self.start_cost))
+        order, reversed_blocks = [], []
+        while True:
+            order.append(state // 2)
+            reversed_blocks.append(bool(state % 2))
+            remaining[state // 2] = False
+            if not remaining.any():
+                return order, reversed_blocks
+            candidates = np.where(np.repeat(remaining, 2), transition[state], np.inf)
+            state = int(candidates.argmin())
+
+    def neighbours(self, order: list[int], reversed_blocks: list[bool]):
+        """
+        Flip, 2-opt and Or-opt moves of the current solution
+        """
+        n = len(order)
+        for i in range(n):
+            flipped = list(reversed_blocks)
+            flipped[i] = not flipped[i]
+            yield order, flipped
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                yield (order[:i] + order[i:j + 1][::-1] + order[j + 1:],
+                       reversed_blocks[:i] + [not r for r in reversed_blocks[i:j + 1][::-1]] + reversed_blocks[j + 1:])
+        for length in range(1, 4):
+            for i in range(n - length + 1):
+                segment, segment_reversed = order[i:i + length], reversed_blocks[i:i + length]
+                rest, rest_reversed = order[:i] + order[i + length:], reversed_blocks[:i] + reversed_blocks[i + length:]
+                for j in range(len(rest) + 1):
+                    if j == i:
+                        continue
+                    yield rest[:j] + segment + rest[j:], rest_reversed[:j] + segment_reversed + rest_reversed[j:]
+
+    def solve(self, time_budget: float = DEFAULT_TIME_BUDGET) -> BlockRoutePlan:
+        """
+        Build a nearest neighbour tour, then improve it with local search until no move helps or time runs out
+        """
+        deadline = time.monotonic() + time_budget
+        order, reversed_blocks = self.nearest_neighbour()
+        cost, resets = self.evaluate(order, reversed_blocks)
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for candidate_order, candidate_reversed in self.neighbours(order, reversed_blocks):
+                candidate_cost, candidate_resets = self.evaluate(candidate_order, candidate_reversed)
+                if candidate_cost < cost:
+                    order, reversed_blocks, cost, resets = candidate_order, candidate_reversed, candidate_cost, candidate_resets
+                    improved = True
+                    break
+                if time.monotonic() >= deadline:
+                    break
+        return BlockRoutePlan(self.block_routes, order, reversed_blocks, resets, cost, self.baseline_cost())
+
+
+def optimize_block_routes(block_routes: list[np.ndarray], time_budget: float = DEFAULT_TIME_BUDGET,
+                          reset_interval: Optional[int] = DEFAULT_RESET_INTERVAL) -> BlockRoutePlan:
+    """
+    Choose the block order, direction and resets of the non-empty block routes
+    """
+    block_routes = [route for route in block_routes if len(route) > 0]
+    if len(block_routes) == 0:
+        return BlockRoutePlan([], [], [], [], 0, 0)
+    return BlockRouteOptimizer(block_routes, reset_interval).solve(time_budget)
@@ -0,0 +1,79 @@
+import numpy as np
+
+from generate_route import VisitList, generate_order
+
+# Marks a line without ink in the span table
+EMPTY_SPAN = 0xFFFF
+
+
+def line_extents(ink: np.ndarray, vertical: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """
+    First and last inked pixel of every line (every column when vertical) of the 120x320 ink array,
+    -1 for both on lines without ink
+    """
+    lines = np.asarray(ink, dtype=bool)
+    if vertical:
+        lines = lines.T
+    has_ink = lines.any(axis=1)
+    starts = np.where(has_ink, lines.argmax(axis=1), -1)
+    ends = np.where(has_ink, lines.shape[1] - 1 - lines[:, ::-1].argmax(axis=1), -1)
+    return starts, ends
+
+
+def pack_span_table(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Pack the extents as little-endian uint16 pairs (start, end) per line, EMPTY_SPAN for both on empty lines
+    """
+    spans = np.stack([starts, ends], axis=1)
+    spans = np.where(spans < 0, EMPTY_SPAN, spans).astype("<u2")
+    return spans.reshape(-1).view(np.uint8)
+
+
+def unpack_span_table(span_table: np.ndarray, line_count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reference decoder of pack_span_table
+    """
+    spans = np.asarray(span_table, dtype=np.uint8)[:4 * line_count].view("<u2").reshape(line_count, 2).astype(int)
+    spans[spans == EMPTY_SPAN] = -1
+    return spans[:, 0], spans[:, 1]
+
+
+def plan_scanline_visits(starts: np.ndarray, ends: np.ndarray, vertical: bool = False) -> np.ndarray:
+    """
+    The (n, 2) array of the points where each sweep enters and leaves its span, from the top left corner.
+    Each span is swept towards whichever end gives the least travel over the whole print, found by
+    dynamic programming over the two ways of sweeping every line.
+    """
+    lines = np.flatnonzero(starts >= 0)
+    if len(lines) == 0:
+        return np.empty((0, 2), dtype=int)
+    # cost[d]: least travel so far, ending the current line at its end (d=0, swept forward) or start (d=1)
+    line_ends = np.stack([ends[lines], starts[lines]], axis=1)
+    line_entries = line_ends[:, ::-1]
+    cost = np.abs(line_entries[0]) + lines[0]
+    choices = []
+    for i in range(1, len(lines)):
+        step = lines[i] - lines[i - 1]
+        travel = np.abs(line_ends[i - 1][:, np.newaxis] - line_entries[i][np.newaxis, :]) + step
+        total = cost[:, np.newaxis] + travel
+        choices.append(total.argmin(axis=0))
+        cost = total.min(axis=0)
+
+    directions = [int(cost.argmin())]
+    for choice in reversed(choices):
+        directions.append(int(choice[directions[-1]]))
+    directions.reverse()
+
+    along = np.stack([line_entries[np.arange(len(lines)), directions],
+                      line_ends[np.arange(len(lines)), directions]], axis=1).reshape(-1)
+    across = np.repeat(lines, 2)
+    visits = np.stack([along, across], axis=1) if vertical else np.stack([across, along], axis=1)
+    return visits
+
+
+def plan_scanline_route(ink: np.ndarray, vertical: bool = False) -> np.ndarray:
+    """
+    The 2-bit command list sweeping only the inked span of every line
+    """
+    starts, ends = line_extents(ink, vertical)
+    return generate_order(VisitList(plan_scanline_visits(starts, ends, vertical)))
@@ -0,0 +1,165 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from tsp_solver_dp import solve_tsp_dynamic_programming
+
+# Largest instances solved exactly, which dynamic programming does in a few milliseconds
+EXACT_MAX_NODES = 12
+# Largest instances built with the greedy solver and improved with the full 2-opt and Or-opt neighbourhoods;
+# bigger ones start from the nearest neighbour tour and only try 2-opt moves within LARGE_TWO_OPT_WINDOW positions
+MEDIUM_MAX_NODES = 200
+LARGE_TWO_OPT_WINDOW = 50
+# Longest run of nodes moved by Or-opt
+OR_OPT_LENGTH = 3
+# Seconds of search every block may take
+DEFAULT_BLOCK_BUDGET = 2.0
+
+
+class TspResult:
+    """
+    Open path from node 0 through every node, found by solver.
+    complete is False when the search was stopped by its deadline rather than reaching a local optimum.
+    """
+    def __init__(self, permutation: list[int], cost: float, solver: str, complete: bool):
+        self.permutation = permutation
+        self.cost = cost
+        self.solver = solver
+        self.complete = complete
+
+
+def path_cost(distance_matrix: np.ndarray, path) -> float:
+    path = np.asarray(path, dtype=int)
+    return float(distance_matrix[path[:-1], path[1:]].sum())
+
+
+def out_of_time(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def nearest_neighbour_path(distance_matrix: np.ndarray) -> np.ndarray:
+    """
+    Path from node 0 always going to the nearest node not visited yet
+    """
+    node_count = len(distance_matrix)
+    distances = np.array(distance_matrix, dtype=float)
+    distances[:, 0] = np.inf
+    path = np.zeros(node_count, dtype=int)
+    for i in range(1, node_count):
+        path[i] = distances[path[i - 1]].argmin()
+        distances[:, path[i]] = np.inf
+    return path
+
+
+def two_opt_pass(distance_matrix: np.ndarray, path: np.ndarray, deadline: Optional[float],
+                 window: Optional[int] = None) -> bool:
+    """
+    Reverse the run of nodes path[i:j + 1] wherever it shortens the path, for every i, in place.
+    The matrix may be asymmetric: the cost of the reversed run comes from prefix sums of the backward edges.
+    Returns whether the path got shorter.
+    """
+    node_count = len(path)
+    improved = False
+    stale = True
+    for i in range(1, node_count - 1):
+        if out_of_time(deadline):
+            break
+        if stale:
+            forward = distance_matrix[path[:-1], path[1:]]
+            forward_sums = np.concatenate([[0], np.cumsum(forward)])
+            backward_sums = np.concatenate([[0], np.cumsum(distance_matrix[path[1:], path[:-1]])])
+            stale = False
+        j = np.arange(i + 1, node_count if window is None else min(node_count, i + window + 1))
+        has_next = j < node_count - 1
+        following = path[np.minimum(j + 1, node_count - 1)]
+        old = (forward[i - 1] + forward_sums[j] - forward_sums[i]
+               + np.where(has_next, forward[np.minimum(j, node_count - 2)], 0))
+        new = (distance_matrix[path[i - 1], path[j]] + backward_sums[j] - backward_sums[i]
+               + np.where(has_next, distance_matrix[path[i], following], 0))
+        delta = new - old
+        best = int(delta.argmin())
+        if delta[best] < -1e-9:
+            path[i:j[best] + 1] = path[i:j[best] + 1][::-1].copy()
+            improved = stale = True
+    return improved
+
+
+def or_opt_pass(distance_matrix: np.ndarray, path: np.ndarray, deadline: Optional[float]) -> bool:
+    """
+    Move runs of 1 to OR_OPT_LENGTH nodes wherever they shorten the path, in place.
+    Returns whether the path got shorter.
+    """
+    node_count = len(path)
+    improved = False
+    positions = np.arange(node_count)
+    for length in range(1, OR_OPT_LENGTH + 1):
+        i = 1
+        while i + length <= node_count:
+            if out_of_time(deadline):
+                return improved
+            forward = distance_matrix[path[:-1], path[1:]]
+            start, end = path[i], path[i + length - 1]
+            previous = path[i - 1]
+            removed = forward[i - 1]
+            if i + length < node_count:
+                removed += forward[i + length - 1] - distance_matrix[previous, path[i + length]]
+            # Insert the run between path[k] and path[k + 1], or after the last node
+            has_next = positions < node_count - 1
+            inserted = (distance_matrix[path, start]
+                        + np.where(has_next, distance_matrix[end, path[np.minimum(positions + 1, node_count - 1)]]
+                                   - np.append(forward, 0), 0))
+            delta = np.where((positions < i - 1) | (positions > i + length - 1), inserted - removed, np.inf)
+            k = int(delta.argmin())
+            if delta[k] < -1e-9:
+                run = path[i:i + length].copy()
+                rest = np.concatenate([path[:i], path[i + length:]])
+                k = k if k < i else k - length
+                path[:] = np.concatenate([rest[:k + 1], run, rest[k + 1:]])
+                improved = True
+            i += 1
+    return improved
+
+
+def local_search(distance_matrix: np.ndarray, path: np.ndarray, deadline: Optional[float] = None,
+                 window: Optional[int] = None) -> tuple[np.ndarray, bool]:
+    """
+    Apply 2-opt and Or-opt passes until neither helps or the deadline passes.
+    The path only ever gets shorter, so it's the best one found whenever the search stops.
+    Returns the path and whether it reached a local optimum.
+    """
+    path = np.array(path, dtype=int)
+    improved = True
+    while improved:
+        improved = two_opt_pass(distance_matrix, path, deadline, window)
+        improved = or_opt_pass(distance_matrix, path, deadline) or improved
+        if out_of_time(deadline):
+            return path, False
+    return path, True
+
+
+def solve_open_path(distance_matrix: np.ndarray, deadline: Optional[float] = None) -> TspResult:
+    """
+    Shortest open path from node 0 through every node, with the solver suited to the instance size:
+    exact dynamic programming up to EXACT_MAX_NODES, then the greedy solver followed by 2-opt and Or-opt,
+    then the nearest neighbour tour followed by a narrower 2-opt and Or-opt.
+    The local search stops at deadline (a time.monotonic() value), keeping the best path found.
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    node_count = len(distance_matrix)
+    if node_count <= 2:
+        permutation = list(range(node_count))
+        return TspResult(permutation, path_cost(distance_matrix, permutation), "trivial", True)
+    if node_count <= EXACT_MAX_NODES:
+        permutation, cost = solve_tsp_dynamic_programming(distance_matrix, open_path=True)
+        return TspResult(permutation, cost, "exact", True)
+
+    if node_count <= MEDIUM_MAX_NODES:
+        from tsp_solver.greedy_numpy import solve_tsp as tsp_solver_greedy
+        solver, window = "greedy", None
+        path = tsp_solver_greedy(distance_matrix, optim_steps=0, endpoints=(0, None))
+    else:
+        solver, window = "search", LARGE_TWO_OPT_WINDOW
+        path = nearest_neighbour_path(distance_matrix)
+    path, complete = local_search(distance_matrix, path, deadline, window)
+    return TspResult(path.tolist(), path_cost(distance_matrix, path), solver, complete)
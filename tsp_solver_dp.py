@@ -1,14 +1,27 @@
 #Original file from Splatplost (https://github.com/Victrid/splatplost), written by Victrid (Jiang Weihao)
 
-from functools import lru_cache
-from typing import Dict, List, Optional, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 
+# Default memory allowed for the cost and parent tables: 256 MiB, enough for 20 nodes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def dynamic_programming_memory(node_count: int) -> int:
+    """
+    Bytes needed by the cost (float64) and parent (int8) tables for ``node_count`` nodes.
+    """
+    if node_count <= 1:
+        return 0
+    subset_nodes = node_count - 1
+    return (1 << subset_nodes) * subset_nodes * (np.dtype(np.float64).itemsize + np.dtype(np.int8).itemsize)
+
 
 def solve_tsp_dynamic_programming(
     distance_matrix: np.ndarray,
-    maxsize: Optional[int] = None,
+    open_path: bool = False,
+    memory_budget: Optional[int] = DEFAULT_MEMORY_BUDGET,
 ) -> Tuple[List, float]:
     """
     Solve TSP to optimality with dynamic programming.
@@ -17,10 +30,12 @@ def solve_tsp_dynamic_programming(
     distance_matrix
         Distance matrix of shape (n x n) with the (i, j) entry indicating the
         distance from node i to j. It does not need to be symmetric
-    maxsize
-        Parameter passed to ``lru_cache`` decorator. Used to define the maximum
-        size for the recursion tree. Defaults to `None`, which essentially
-        means "take as much space as needed".
+    open_path
+        If True, the path starts at node 0 and ends at whichever node gives
+        the least distance, without going back to 0.
+    memory_budget
+        Maximum number of bytes the cost and parent tables may use. Defaults
+        to ``DEFAULT_MEMORY_BUDGET``; `None` means no limit.
     Returns
     -------
     permutation
@@ -28,75 +43,89 @@ def solve_tsp_dynamic_programming(
         distance
     distance
         The total distance the optimal permutation produces
+    Raises
+    ------
+    MemoryError
+        If the tables for this many nodes would exceed ``memory_budget``.
     Notes
     -----
     Algorithm: cost of the optimal path
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    Consider a TSP instance with 3 nodes: {0, 1, 2}. Let dist(0, {1, 2}) be the
-    distance from 0, visiting all nodes in {1, 2} and going back to 0. This can
-    be computed recursively as:
-        dist(0, {1, 2}) = min(
-            c_{0, 1} + dist(1, {2}),
-            c_{0, 2} + dist(2, {1}),
-        )
-    wherein c_{0, 1} is the cost from going from 0 to 1 in the distance matrix.
-    The inner dist(1, {2}) is computed as:
-        dist(1, {2}) = min(
-            c_{1, 2} + dist(2, {}),
-        )
-    and similarly for dist(2, {1}). The stopping point in the recursion is:
-        dist(2, {}) = c_{2, 0}.
-    This process can be generalized as:
-        dist(ni, N) =   min   ( c_{ni, nj} + dist(nj, N - {nj}) )
-                      nj in N
-    and
-        dist(ni, {}) = c_{ni, 0}
-    With starting point as dist(0, {1, 2, ..., tsp_size}). The notation
-    N - {nj} is the difference operator, meaning set N without node nj.
+    Nodes 1 to n - 1 are numbered 0 to m - 1 in the tables, and a subset of
+    them is stored as a bitmask. Let cost[S, j] be the least distance going
+    from node 0 through every node of S, ending at node j (j in S). Then:
+        cost[{j}, j] = c_{0, j}
+        cost[S, j] =     min      ( cost[S - {j}, i] + c_{i, j} )
+                     i in S - {j}
+    The subsets are filled by increasing size, so every cost[S - {j}, :] is
+    known when cost[S, j] is computed. For every size and every j, the
+    minimization over i is done at once for all the subsets with a NumPy
+    gather, since cost[S - {j}, i] is infinite whenever i is not in S - {j}.
+    The distance of the closed tour is then
+        min ( cost[{1, ..., m}, j] + c_{j, 0} )
+    and the distance of the open path is the same without c_{j, 0}.
     Algorithm: compute the optimal path
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    The previous process returns the distance of the optimal path. To find the
-    actual path, we need to store in a memory the following key/values:
-        memo[(ni, N)] = nj_min
-    with nj_min the node in N that provided the smallest value of dist(ni, N).
-    Then, the process goes backwards starting from
-    memo[(0, {1, 2, ..., tsp_size})].
-    In the previous example, suppose memo[(0, {1, 2})] = 1.
-    Then, look for memo[(1, {2})] = 2.
-    Then, since the next step would be memo[2, {}], stop there. The optimal
-    path would be 0 -> 1 -> 2 -> 0.
+    Along with the cost, parent[S, j] stores the i that gave the least
+    distance. The path is found going backwards from the best last node,
+    removing it from S at each step.
+    Memory used by the tables is 2^(n - 1) * (n - 1) * 9 bytes, so n = 20
+    takes about 90 MB.
     Reference
     ---------
     https://en.wikipedia.org/wiki/Held%E2%80%93Karp_algorithm#cite_note-5
     """
-    # Get initial set {1, 2, ..., tsp_size} as a frozenset because @lru_cache
-    # requires a hashable type
-    N = frozenset(range(1, distance_matrix.shape[0]))
-    memo: Dict[Tuple, int] = {}
+    distance_matrix = np.asarray(distance_matrix, dtype=np.float64)
+    node_count = distance_matrix.shape[0]
+    if node_count == 0:
+        return [], 0.0
+    if node_count == 1:
+        return [0], 0.0 if open_path else float(distance_matrix[0, 0])
 
-    # Step 1: get minimum distance
-    @lru_cache(maxsize=maxsize)
-    def dist(ni: int, N: frozenset) -> float:
-        if not N:
-            return distance_matrix[ni, 0]
+    needed_memory = dynamic_programming_memory(node_count)
+    if memory_budget is not None and needed_memory > memory_budget:
+        raise MemoryError(
+            f"Dynamic programming for {node_count} nodes needs {needed_memory} bytes, "
+            f"over the budget of {memory_budget} bytes"
+        )
 
-        # Store the costs in the form (nj, dist(nj, N))
-        costs = [
-            (nj, distance_matrix[ni, nj] + dist(nj, N.difference({nj})))
-            for nj in N
-        ]
-        nmin, min_cost = min(costs, key=lambda x: x[1])
-        memo[(ni, N)] = nmin
-        return min_cost
+    m = node_count - 1
+    subset_count = 1 << m
+    inner_distance = distance_matrix[1:, 1:]
+    nodes = np.arange(m)
 
-    best_distance = dist(0, N)
+    cost = np.full((subset_count, m), np.inf)
+    parent = np.full((subset_count, m), -1, dtype=np.int8)
+    cost[1 << nodes, nodes] = distance_matrix[0, 1:]
+
+    # Step 1: get minimum distance, one subset size at a time
+    subsets = np.arange(subset_count)
+    subset_size = np.zeros(subset_count, dtype=np.int8)
+    for node in range(m):
+        subset_size += (subsets >> node) & 1
+    for size in range(2, m + 1):
+        layer = subsets[subset_size == size]
+        for j in range(m):
+            selected = layer[(layer >> j) & 1 == 1]
+            candidates = cost[selected ^ (1 << j)] + inner_distance[:, j]
+            best = candidates.argmin(axis=1)
+            cost[selected, j] = candidates[np.arange(len(selected)), best]
+            parent[selected, j] = best
 
     # Step 2: get path with the minimum distance
-    ni = 0  # start at the origin
-    solution = [0]
-    while N:
-        ni = memo[(ni, N)]
-        solution.append(ni)
-        N = N.difference({ni})
+    full_set = subset_count - 1
+    final_cost = cost[full_set]
+    if not open_path:
+        final_cost = final_cost + distance_matrix[1:, 0]
+    last = int(final_cost.argmin())
+    best_distance = float(final_cost[last])
+
+    reversed_path = []
+    subset = full_set
+    while last >= 0:
+        reversed_path.append(last + 1)
+        previous = int(parent[subset, last])
+        subset ^= 1 << last
+        last = previous
 
-    return solution, best_distance
\ No newline at end of file
+    return [0] + reversed_path[::-1], best_distance
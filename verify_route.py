@@ -0,0 +1,197 @@
+#!/bin/python
+
+import sys, getopt
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from emulator import OPTIONS_OFFSET, FIX_OFFSET, PrintOptions, read_image_data, image_bits, replay_commands
+from command_codec import decode_rle
+from generate_route import RESET_SEGMENTS, RESET_CORNERS, LEFT, RIGHT
+
+# The length header and the packed commands follow the options, the fix lines and the pixels
+ROUTE_OFFSET = OPTIONS_OFFSET + FIX_OFFSET + 4800
+# A reset sweeps half the canvas width, then half its height
+RESET_WIDTH, RESET_HEIGHT = (int(length) for length in RESET_SEGMENTS["lu"][1])
+
+
+class RouteReport:
+    """
+    Coverage and travel of an optimal mode route replayed on the canvas.
+    Steps reaching a pixel to ink for the first time ink it; every other step is travel, resets included.
+    """
+    def __init__(self, commands: np.ndarray, positions: np.ndarray, target: np.ndarray, resets: np.ndarray):
+        self.commands = len(commands)
+        self.resets = len(resets)
+        pixels = positions[:, 0] * 320 + positions[:, 1]
+        self.visits = np.bincount(pixels, minlength=120 * 320).reshape(120, 320)
+        self.target = target
+        self.missed_mask = target & (self.visits == 0)
+
+        first_visit = np.zeros(len(pixels), dtype=bool)
+        first_visit[np.unique(pixels, return_index=True)[1]] = True
+        inking = first_visit[1:] & target.reshape(-1)[pixels[1:]]
+        self.ink_steps = int(np.count_nonzero(inking))
+        self.travel_steps = self.commands - self.ink_steps
+        self.clamped_steps = int(np.count_nonzero((positions[1:] == positions[:-1]).all(axis=1)))
+        self.travel_heat = np.bincount(pixels[1:][~inking], minlength=120 * 320).reshape(120, 320)
+
+    @property
+    def ink_pixels(self) -> int:
+        return int(np.count_nonzero(self.target))
+
+    @property
+    def missed(self) -> int:
+        return int(np.count_nonzero(self.missed_mask))
+
+    @property
+    def revisited(self) -> int:
+        """
+        Pixels to ink that the cursor stops on more than once
+        """
+        return int(np.count_nonzero(self.target & (self.visits > 1)))
+
+    @property
+    def travel_ratio(self) -> float:
+        return self.travel_steps / max(self.ink_steps, 1)
+
+
+def unpack_route(image_data: np.ndarray) -> np.ndarray:
+    """
+    The 2-bit commands of an optimal mode image_data, decoded from the length header and the packed bytes,
+    or from the run-length encoded stream when bit 7 of the options says so
+    """
+    data = np.asarray(image_data, dtype=np.uint8)
+    if len(data) < ROUTE_OFFSET + 2 or not PrintOptions(int(data[0])).opposite:
+        raise ValueError("This image_data holds no optimal mode route!")
+    options = PrintOptions(int(data[0]))
+    length = int(data[ROUTE_OFFSET]) | int(data[ROUTE_OFFSET + 1]) << 8
+    if options.compressed:
+        stream = data[ROUTE_OFFSET + 2:ROUTE_OFFSET + 2 + length]
+        if len(stream) < length:
+            raise ValueError(f"The route should hold {length} bytes, but the image_data ends after {len(stream)}!")
+        return decode_rle(stream)
+    packed = data[ROUTE_OFFSET + 2:ROUTE_OFFSET + 2 + (length + 3) // 4]
+    if len(packed) * 4 < length:
+        raise ValueError(f"The route should hold {length} commands, but the image_data ends after {len(packed) * 4}!")
+    commands = packed[:, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8) & 0x3
+    return commands.reshape(-1)[:length]
+
+
+def find_resets(commands: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Indices of the commands starting a corner reset: RESET_WIDTH horizontal steps then exactly RESET_HEIGHT
+    vertical ones, ending in a corner
+    """
+    commands = np.asarray(commands)
+    if len(commands) == 0:
+        return np.empty(0, dtype=int)
+    starts = np.flatnonzero(np.diff(commands, prepend=-1))
+    lengths = np.diff(starts, append=len(commands))
+    directions = commands[starts]
+    horizontal = (directions == LEFT) | (directions == RIGHT)
+    candidates = np.flatnonzero(horizontal[:-1] & (lengths[:-1] >= RESET_WIDTH)
+                                & ~horizontal[1:] & (lengths[1:] == RESET_HEIGHT))
+    ends = positions[starts[candidates + 1] + RESET_HEIGHT]
+    in_corner = (ends[:, np.newaxis, :] == RESET_CORNERS[np.newaxis, :, :]).all(axis=2).any(axis=1)
+    return starts[candidates[in_corner] + 1] - RESET_WIDTH
+
+
+def route_targets(bits: np.ndarray) -> list[np.ndarray]:
+    """
+    The pixels an optimal route may have to visit: the colour with fewer pixels, since the planner routes
+    those and the firmware fills the rest. With as many pixels of both colours, either one.
+    """
+    black = bits == 1
+    black_count = int(np.count_nonzero(black))
+    if black_count == black.size // 2:
+        return [black, ~black]
+    return [black if black_count < black.size // 2 else ~black]
+
+
+def verify_route(image_data: np.ndarray, target: Optional[np.ndarray] = None) -> RouteReport:
+    """
+    Replay the packed route of an optimal mode image_data on the canvas, clamped at the edges like the console,
+    and check it against target, the boolean 120x320 array of the pixels it must visit
+    (by default the pixels the planner routes, found from the image bits)
+    """
+    commands = unpack_route(image_data)
+    positions = replay_commands(commands)
+    resets = find_resets(commands, positions)
+    targets = [np.asarray(target, dtype=bool)] if target is not None else route_targets(image_bits(image_data))
+    reports = [RouteReport(commands, positions, candidate, resets) for candidate in targets]
+    return min(reports, key=lambda report: report.missed)
+
+
+def print_route_report(report: RouteReport):
+    print(f"Route replay: {report.commands} commands, {report.resets} resets, "
+          f"{report.clamped_steps} steps stopped by the canvas edges")
+    print(f"Pixels to visit: {report.ink_pixels}, missed: {report.missed}, visited more than once: {report.revisited}")
+    print(f"Travel steps: {report.travel_steps}, travel/ink ratio: {report.travel_ratio:.3f}")
+    if report.missed > 0:
+        print(f"WARNING: The route misses {report.missed} pixels, which would print wrong!")
+
+
+def save_heatmap(report: RouteReport, filename: str, scale: int = 2):
+    """
+    Save the wasted travel as a PNG: the pixels to visit in gray, missed ones in blue,
+    and darker red where the cursor travelled more often
+    """
+    image = np.full((120, 320, 3), 255, dtype=np.uint8)
+    image[report.target] = (200, 200, 200)
+    heat = np.log1p(report.travel_heat) / max(np.log1p(report.travel_heat.max()), 1e-9)
+    travelled = report.travel_heat > 0
+    image[travelled, 0] = (255 - 100 * heat[travelled]).astype(np.uint8)
+    image[travelled, 1] = (200 * (1 - heat[travelled])).astype(np.uint8)
+    image[travelled, 2] = (200 * (1 - heat[travelled])).astype(np.uint8)
+    image[report.missed_mask] = (0, 0, 255)
+    Image.fromarray(image).resize((320 * scale, 120 * scale), Image.NEAREST).save(filename)
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "ht:m:", ["help", "target=", "heatmap="])
+    target = None
+    heatmap_filename = None
+    for opt, arg in opts:
+        if opt in ['-h', '--help']:
+            usage()
+            sys.exit()
+        elif opt in ['-t', '--target']:
+            target = np.asarray(Image.open(arg).convert("1")) == 0
+        elif opt in ['-m', '--heatmap']:
+            heatmap_filename = arg
+
+    failed = False
+    for filename in args:
+        try:
+            report = verify_route(read_image_data(filename), target)
+        except ValueError as e:
+            print(f"{filename}: ERROR: {e}")
+            failed = True
+            continue
+        print(f"{filename}:")
+        print_route_report(report)
+        failed = failed or report.missed > 0
+        if heatmap_filename is not None:
+            save_heatmap(report, heatmap_filename)
+            print(f"Travel heatmap saved to {heatmap_filename}!")
+    if failed:
+        sys.exit(1)
+
+
+def usage():
+    print("To check the optimal mode routes of generated files: verify_route.py [-options] <splat_image.c> ...")
+    print("\n--help [-h]: Show this help list")
+    print("--target [-t] <image.png>: Black pixels the route must visit (default: those the planner routes)")
+    print("  * Needed for repair routes, which only visit the wrong pixels of a print.")
+    print("--heatmap [-m] <heatmap.png>: Save where the cursor travelled without inking, darker where it went more often")
+    print("\nExits with 1 when a route misses pixels.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv[1:]) == 0:
+        usage()
+        sys.exit
+    else:
+        main(sys.argv[1:])